@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Replays a burst of pings through sendmail_notify, as after a netsplit
+rejoin or a mass highlight, into a transport that delivers only a few
+emails per second, and reports per priority class how long notifications
+waited in the queue and how many were shed. Time is the virtual clock of
+the stand-in weechat module, so runs are reproducible.
+
+Exits with status 1 if a private message waited longer than --bound
+seconds. --fifo queues everything in one class, as before priorities.
+
+    python bench/bench_load_spike.py
+    python bench/bench_load_spike.py --fifo
+    python bench/bench_load_spike.py --highlights 2000 -o queue_size=500
+"""
+
+import argparse
+import os
+import random
+import sys
+from collections import OrderedDict
+
+import weechat
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'sendmail_notify.py')
+STEP = 0.01
+
+
+class SlowTransport(object):
+    """Delivers at most concurrency emails at a time, each taking
+       duration seconds of virtual time
+    """
+
+    def __init__(self, script, concurrency, duration):
+        self.script = script
+        self.concurrency = concurrency
+        self.duration = duration
+        self.busy = []
+
+    def has_capacity(self):
+        return len(self.busy) < self.concurrency
+
+    def batch_size(self):
+        return 1
+
+    def deliver(self, notifications):
+        for notification in notifications:
+            self.busy.append((weechat.now + self.duration, notification))
+
+    def finish(self):
+        """Completes the deliveries that are due, returns True if any"""
+        due = [item for item in self.busy if item[0] <= weechat.now]
+        for item in due:
+            self.busy.remove(item)
+            self.script.delivery_done(item[1])
+        return bool(due)
+
+    def close(self):
+        pass
+
+
+def generate(args):
+    """Yields (time, tags, buffer type, channel, highlight, prefix,
+       message) for a burst of highlights, watched keywords and private
+       messages spread over args.burst seconds
+    """
+    rand = random.Random(args.seed)
+    lines = []
+    for kind, count in (('highlight', args.highlights),
+                        ('watched', args.watched),
+                        ('private', args.private)):
+        for i in range(count):
+            # a sender each, so no ping is suppressed as a repeat
+            nick = '%s%d' % (kind, i)
+            if kind == 'private':
+                line = ('notify_private', 'private', nick, '0', nick,
+                        'are you there? %d' % i)
+            elif kind == 'watched':
+                line = ('notify_message', 'channel', '#ops', '0', nick,
+                        'deploy %d is stuck' % i)
+            else:
+                line = ('notify_message', 'channel', '#chan%d' % (i % 20),
+                        '1', nick, 'trey: welcome back %d' % i)
+            lines.append((rand.uniform(0, args.burst),) + line)
+    lines.sort()
+    return lines
+
+
+def run(args, options):
+    weechat.reset()
+    weechat.plugin_options.update({
+        'to': 'me@example.com', 'from': 'weechat@example.com',
+        'spool': 'off', 'only_when_away': 'off', 'watchlist': 'deploy',
+        'sender_rate': '1000/1', 'global_rate': '100000/1'})
+    weechat.plugin_options.update(options)
+    script = weechat.load_script(SCRIPT)
+    transport = script.TRANSPORTS['bench'] = SlowTransport(
+        script, args.concurrency, args.duration)
+    weechat.config_set_plugin('transport', 'bench')
+
+    # note when each notification was queued, handed over and shed
+    queued = {}
+    waits = OrderedDict((priority, []) for priority in script.PRIORITIES)
+    shed = dict.fromkeys(script.PRIORITIES, 0)
+    kinds = {}
+    enqueue, deliver = script.enqueue, transport.deliver
+    delivery_done = script.delivery_done
+
+    def bench_enqueue(notification):
+        kinds[id(notification)] = notification.priority
+        if args.fifo:
+            notification.priority = 'highlight'
+        queued[id(notification)] = weechat.now
+        enqueue(notification)
+
+    def bench_deliver(notifications):
+        for notification in notifications:
+            waits[kinds[id(notification)]].append(
+                weechat.now - queued[id(notification)])
+        deliver(notifications)
+
+    def bench_delivery_done(notification, error=None, retry=True):
+        if error:
+            shed[kinds[id(notification)]] += 1
+        delivery_done(notification, error, retry)
+
+    script.enqueue = bench_enqueue
+    script.delivery_done = bench_delivery_done
+    transport.deliver = bench_deliver
+
+    buffers = {}
+    hooks = weechat.print_hooks
+    for when, tags, buffer_type, channel, highlight, prefix, message in \
+            generate(args):
+        while weechat.now + STEP <= when:
+            weechat.advance(STEP)
+            if transport.finish():
+                script.schedule_drain()
+        msg_buffer = buffers.get(channel)
+        if msg_buffer is None:
+            msg_buffer = buffers[channel] = weechat.add_buffer(
+                'net', channel, buffer_type)
+        for hook in hooks(tags):
+            getattr(script, hook.callback)(hook.data, msg_buffer, '0', tags,
+                                           '1', highlight, prefix, message)
+    while transport.busy or script.queue_length():
+        weechat.advance(STEP)
+        if transport.finish():
+            script.schedule_drain()
+    return waits, shed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--highlights', type=int, default=600)
+    parser.add_argument('--watched', type=int, default=40)
+    parser.add_argument('--private', type=int, default=10)
+    parser.add_argument('--burst', type=float, default=2.0,
+                        help='seconds the pings arrive over')
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=0.5,
+                        help='seconds one delivery takes')
+    parser.add_argument('--bound', type=float, default=5.0,
+                        help='longest a private message may wait')
+    parser.add_argument('--fifo', action='store_true',
+                        help='queue every ping in the same class')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='set a sendmail_notify option')
+    args = parser.parse_args()
+    options = dict(option.split('=', 1) for option in args.option)
+
+    waits, shed = run(args, options)
+    print('%-10s %7s %6s %8s %8s %8s' % ('class', 'sent', 'shed', 'p50 s',
+                                         'p99 s', 'max s'))
+    for priority, times in waits.items():
+        times.sort()
+        if times:
+            p50 = times[len(times) // 2]
+            p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+            print('%-10s %7d %6d %8.2f %8.2f %8.2f' % (
+                priority, len(times), shed[priority], p50, p99, times[-1]))
+        else:
+            print('%-10s %7d %6d %8s %8s %8s' % (priority, 0, shed[priority],
+                                                 '-', '-', '-'))
+
+    private = waits['private']
+    if shed['private'] or (private and private[-1] > args.bound):
+        print('private messages waited longer than %.1fs or were shed' %
+              args.bound)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the infolist and hdata ways screen_away can scan irc servers and
+relay clients, at 10, 100 and 1000 of each, and checks both find the same
+servers and connected clients. Reports per scan how many items are copied,
+the memory allocated at the peak, and how many weechat API calls are made.
+Like WeeChat, the stand-in weechat module copies every item into a new
+infolist, so copies and memory differ between the scans here as they do in
+WeeChat. Timings would only measure the stand-in and are not reported.
+
+    python bench/bench_screen_away_scan.py
+    python bench/bench_screen_away_scan.py --sizes 10,100,1000,5000
+"""
+
+import argparse
+import os
+import sys
+
+import weechat
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'screen_away.py')
+API = ('infolist_get', 'infolist_next', 'infolist_string', 'infolist_integer',
+       'infolist_pointer', 'infolist_free', 'hdata_get', 'hdata_get_list',
+       'hdata_move', 'hdata_string', 'hdata_integer', 'hdata_pointer')
+calls = [0]
+copies = [0]
+
+
+def count_calls():
+    """Wraps the weechat functions scans use so calls to them, and the items
+       infolist_get copies, are counted
+    """
+    def counted(function):
+        def wrapper(*args):
+            calls[0] += 1
+            return function(*args)
+        return wrapper
+    for name in API:
+        setattr(weechat, name, counted(getattr(weechat, name)))
+    infolist_get = weechat.infolist_get
+
+    def copying(*args):
+        infolist = infolist_get(*args)
+        copies[0] += len(infolist.items)
+        return infolist
+    weechat.infolist_get = copying
+
+
+def infolist_servers():
+    """The server scan as it was done with the irc_server infolist"""
+    w = weechat
+    servers = {}
+    infolist = w.infolist_get('irc_server', '', '')
+    while w.infolist_next(infolist):
+        servers[w.infolist_string(infolist, 'name')] = {
+            'is_connected': w.infolist_integer(infolist, 'is_connected') == 1,
+            'is_away': w.infolist_integer(infolist, 'is_away'),
+            'away_message': w.infolist_string(infolist, 'away_message'),
+            'buffer': w.infolist_pointer(infolist, 'buffer'),
+            'nick': w.infolist_string(infolist, 'nick'),
+        }
+    w.infolist_free(infolist)
+    return servers
+
+
+def infolist_relays():
+    """The relay scan as it was done with the relay infolist"""
+    w = weechat
+    connected = 0
+    infolist = w.infolist_get('relay', '', '')
+    while w.infolist_next(infolist):
+        if w.infolist_string(infolist, 'status_string') == 'connected':
+            connected += 1
+    w.infolist_free(infolist)
+    return connected
+
+
+def measure(scan):
+    """Returns (items copied, peak bytes or None where tracemalloc isn't
+       available, API calls) of one scan. A first scan is not measured, it
+       lets the stand-in link its hdata lists.
+    """
+    scan()
+    calls[0] = copies[0] = 0
+    try:
+        import tracemalloc
+    except ImportError:
+        scan()
+        return copies[0], None, calls[0]
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    scan()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return copies[0], peak - base, calls[0]
+
+
+def kib(size):
+    return '%.1f' % (size / 1024.0) if size is not None else 'n/a'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000')
+    args = parser.parse_args()
+
+    weechat.reset()
+    script = weechat.load_script(SCRIPT)
+    count_calls()
+
+    print('%6s %-8s %-9s %8s %10s %8s' % ('items', 'scan', 'way', 'copies',
+                                          'peak KiB', 'calls'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        weechat.infolists['irc_server'] = [
+            {'name': 'net%d' % i, 'is_connected': 1, 'is_away': 0,
+             'away_message': '', 'buffer': '0x%x' % i, 'nick': 'nick'}
+            for i in range(size)]
+        weechat.infolists['relay'] = [
+            {'status': 2 if i % 2 else 4,
+             'status_string': 'connected' if i % 2 else 'disconnected'}
+            for i in range(size)]
+        for name, old, new in (('servers', infolist_servers,
+                                script.load_servers),
+                               ('relays', infolist_relays,
+                                script.seed_relays)):
+            for way, scan in (('infolist', old), ('hdata', new)):
+                copied, peak, made = measure(scan)
+                print('%6d %-8s %-9s %8d %10s %8d' % (
+                    size, name, way, copied, kib(peak), made))
+        if infolist_servers() != script.SERVERS:
+            print('servers found by the scans differ')
+            return 1
+        if infolist_relays() != len(script.RELAY_CLIENTS):
+            print('connected relay clients found by the scans differ')
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Replays IRC traffic through the print hook of sendmail_notify and reports
+what each printed line costs: lines/sec, p50/p99 callback latency and the
+memory allocated on the way. Delivery goes to a stub transport, so only
+the filter and message building path is measured.
+
+    python bench/bench_sendmail_notify.py --lines 1000000
+    python bench/bench_sendmail_notify.py --record traffic.tsv --lines 100000
+    python bench/bench_sendmail_notify.py --log traffic.tsv -o digest=on
+
+Traffic files hold one printed line per row, tab separated: tags, buffer
+type, server, channel, highlight, prefix, message.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from array import array
+
+import weechat
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'sendmail_notify.py')
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class StubTransport(object):
+    """Accepts everything right away and only counts it"""
+
+    def __init__(self, script):
+        self.script = script
+        self.delivered = 0
+
+    def has_capacity(self):
+        return True
+
+    def batch_size(self):
+        return 100
+
+    def deliver(self, notifications):
+        for notification in notifications:
+            self.delivered += 1
+            self.script.delivery_done(notification)
+
+    def close(self):
+        pass
+
+
+def generate(lines, seed):
+    """Yields a mix of channel chatter, joins/parts, highlights and private
+       messages over a few servers
+    """
+    rand = random.Random(seed)
+    servers = ['net%d' % i for i in range(4)]
+    channels = ['#chan%d' % i for i in range(50)]
+    nicks = ['nick%d' % i for i in range(200)]
+    words = ('the build is red again can someone look at the deploy '
+             'queue before lunch thanks').split()
+    for _ in range(lines):
+        server = rand.choice(servers)
+        nick = rand.choice(nicks)
+        message = ' '.join(rand.sample(words, 8))
+        kind = rand.random()
+        if kind < 0.05:
+            yield ('irc_join,irc_smart_filter', 'channel', server,
+                   rand.choice(channels), '0', '-->', nick + ' has joined')
+        elif kind < 0.10:
+            yield ('notify_message', 'channel', server,
+                   rand.choice(channels), '1', nick, 'trey: ' + message)
+        elif kind < 0.12:
+            yield ('notify_private', 'private', server, nick, '0', nick,
+                   message)
+        else:
+            yield ('notify_message', 'channel', server,
+                   rand.choice(channels), '0', nick, message)
+
+
+def read_log(path):
+    with open(path) as log:
+        for line in log:
+            yield tuple(line.rstrip('\n').split('\t', 6))
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(traffic, options):
+    weechat.reset()
+    weechat.plugin_options.update({'to': 'me@example.com',
+                                   'from': 'weechat@example.com',
+                                   'spool': 'off'})
+    weechat.plugin_options.update(options)
+    script = weechat.load_script(SCRIPT)
+    transport = script.TRANSPORTS['bench'] = StubTransport(script)
+    weechat.config_set_plugin('transport', 'bench')
+
+    buffers = {}
+    targets = {}
+    latencies = array('d')
+    start = timer()
+    for count, (tags, buffer_type, server, channel, highlight, prefix,
+                message) in enumerate(traffic):
+        msg_buffer = buffers.get((server, channel))
+        if msg_buffer is None:
+            msg_buffer = buffers[(server, channel)] = weechat.add_buffer(
+                server, channel, buffer_type, away='away')
+        callbacks = targets.get(tags)
+        if callbacks is None:
+            callbacks = targets[tags] = [
+                (getattr(script, hook.callback), hook.data)
+                for hook in weechat.print_hooks(tags)]
+
+        before = timer()
+        for callback, data in callbacks:
+            callback(data, msg_buffer, '0', tags, '1', highlight, prefix,
+                     message)
+        latencies.append(timer() - before)
+
+        # let the drain/digest timers run now and then
+        if count % 1000 == 999:
+            weechat.advance(1)
+    elapsed = timer() - start
+    weechat.advance(3600)
+    return latencies, elapsed, transport.delivered
+
+
+def measure_memory(traffic, options):
+    """Returns (peak, retained) bytes allocated while replaying traffic,
+       None where tracemalloc isn't available
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    run(traffic, options)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - base, current - base
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lines', type=int, default=1000000,
+                        help='lines of generated traffic to replay')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log', help='replay this traffic file instead')
+    parser.add_argument('--record',
+                        help='write the generated traffic to this file')
+    parser.add_argument('-o', '--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='set a sendmail_notify option')
+    args = parser.parse_args()
+    options = dict(option.split('=', 1) for option in args.option)
+
+    if args.record:
+        with open(args.record, 'w') as record:
+            for line in generate(args.lines, args.seed):
+                record.write('\t'.join(line) + '\n')
+        return
+
+    if args.log:
+        traffic = list(read_log(args.log))
+    else:
+        traffic = list(generate(args.lines, args.seed))
+
+    latencies, elapsed, delivered = run(traffic, options)
+    ordered = sorted(latencies)
+    print('lines:         %d' % len(traffic))
+    print('emails:        %d' % delivered)
+    print('lines/sec:     %.0f' % (len(traffic) / elapsed))
+    print('callback p50:  %.2f us' % (percentile(ordered, 0.50) * 1e6))
+    print('callback p99:  %.2f us' % (percentile(ordered, 0.99) * 1e6))
+    print('callback max:  %.2f us' % (ordered[-1] * 1e6))
+
+    memory = measure_memory(traffic[:100000], options)
+    if memory is None:
+        print('memory:        n/a (needs tracemalloc)')
+    else:
+        print('memory:        peak %.1f KiB, retained %.1f KiB' %
+              (memory[0] / 1024.0, memory[1] / 1024.0))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
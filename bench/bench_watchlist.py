@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Measures what the sendmail_notify watchlist costs per line as it grows,
+matching generated chat lines against 10 to 10000 keywords.
+
+    python bench/bench_watchlist.py
+    python bench/bench_watchlist.py --lines 50000 --sizes 10,1000,100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import weechat
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'sendmail_notify.py')
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def keywords(count, rand):
+    """Ticket ids, hostnames and service names"""
+    kinds = ('PROJ-%d', 'db%d.example.com', 'svc-%d')
+    return ['%s' % (kinds[i % 3] % i) for i in rand.sample(range(count * 10),
+                                                           count)]
+
+
+def chat(lines, rand, words):
+    vocabulary = ('can someone look at the failing job on the staging '
+                  'host before the release goes out tonight').split()
+    for _ in range(lines):
+        line = rand.sample(vocabulary, 10)
+        if rand.random() < 0.05:
+            line.insert(rand.randrange(len(line)), rand.choice(words))
+        yield ' '.join(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--sizes', default='10,100,1000,10000',
+                        help='comma-separated watchlist sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    weechat.reset()
+    script = weechat.load_script(SCRIPT)
+    print('%8s %12s %10s %8s' % ('keywords', 'compile ms', 'us/line',
+                                 'hits'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        rand = random.Random(args.seed)
+        words = keywords(size, rand)
+        lines = list(chat(args.lines, rand, words))
+
+        start = timer()
+        weechat.config_set_plugin('watchlist', ','.join(words))
+        compiled = timer() - start
+
+        hits = 0
+        start = timer()
+        for line in lines:
+            if script.watch_hits(line):
+                hits += 1
+        elapsed = timer() - start
+        print('%8d %12.1f %10.2f %8d' % (size, compiled * 1000,
+                                         elapsed / len(lines) * 1e6, hits))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+Drives screen_away.py through scripted attach, detach, relay, mosh and
+tmux control mode scenarios without WeeChat, screen or tmux, and checks
+the commands it sends. Then measures what a timer tick and an away/back
+transition cost at 1 to 500 servers.
+
+The session socket is a plain file in a temporary directory whose X bit
+is flipped to attach and detach, the mosh state file lives next to it,
+and time is the virtual clock of the stand-in weechat module, so every
+run sends the same commands at the same virtual times. Scenarios run
+with the interval timer and again with inotify watching those files, a
+tmux control mode connection is fed output recorded from tmux.
+
+    python bench/sim_screen_away.py
+    python bench/sim_screen_away.py --no-bench
+    python bench/sim_screen_away.py --sizes 1,10,100,500,2000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import weechat
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'screen_away.py')
+timer = getattr(time, 'perf_counter', time.time)
+CALLS = [0]
+
+
+class Clock(object):
+    """Stands in for the time module of a loaded script"""
+
+    @staticmethod
+    def time():
+        return weechat.now
+
+    @staticmethod
+    def strftime(format):
+        return time.strftime(format, time.gmtime(weechat.now))
+
+
+class Sim(object):
+    """The script loaded with servers, a socket and a mosh state file"""
+
+    def __init__(self, directory, servers=2, **options):
+        self.sock = os.path.join(directory, 'sock')
+        self.mosh_state = os.path.join(directory, 'mosh_state')
+        if os.path.exists(self.mosh_state):
+            os.remove(self.mosh_state)
+        open(self.sock, 'w').close()
+        self.attach()
+
+        weechat.reset()
+        # a real clock is far from 0, the scripts take 0 as long ago
+        weechat.now = 1e9
+        weechat.plugin_options.update({
+            'use_inotify': 'off', 'tmux_control': 'off',
+            'check_relay': 'yes', 'time_format': 'since then',
+            'mosh_state': self.mosh_state})
+        weechat.plugin_options.update(options)
+        self.servers = ['net%d' % i for i in range(servers)]
+        weechat.infolists['irc_server'] = [
+            {'name': server, 'is_connected': 1, 'is_away': 0,
+             'away_message': '', 'buffer': 'buf.' + server, 'nick': 'me'}
+            for server in self.servers]
+        weechat.infolists['relay'] = []
+
+        os.environ.pop('STY', None)
+        os.environ['TMUX'] = '%s,1,0' % self.sock
+        self.script = weechat.load_script(SCRIPT)
+        self.script.time = Clock
+
+    def attach(self):
+        os.chmod(self.sock, 0o700)
+
+    def detach(self):
+        os.chmod(self.sock, 0o600)
+
+    def set_mosh(self, state):
+        if state is None:
+            os.remove(self.mosh_state)
+        else:
+            with open(self.mosh_state, 'w') as f:
+                f.write(state)
+
+    def tmux(self, output, return_code=-1):
+        """Feeds control mode output a few bytes at a time, as it may
+        arrive from the pipe"""
+        for i in range(0, len(output), 7):
+            self.script.screen_away_tmux_cb('', 'tmux', -1, output[i:i + 7],
+                                            '')
+        if return_code != -1:
+            self.script.screen_away_tmux_cb('', 'tmux', return_code, '', '')
+
+    def close(self):
+        self.script.stop_inotify()
+
+    def relay(self, pointer, signal):
+        weechat.send_signal('relay_client_' + signal, pointer)
+
+    def nick(self, nick):
+        """The servers confirm a nick change"""
+        for server in weechat.infolists['irc_server']:
+            old, server['nick'] = server['nick'], nick
+            weechat.send_signal('%s,irc_in2_nick' % server['name'],
+                                ':%s!me@host NICK :%s' % (old, nick))
+
+    def advance(self, seconds):
+        weechat.advance(seconds)
+
+    def each(self, *commands):
+        """commands as sent to every server, taking turns"""
+        return [('buf.' + server, command) for command in commands
+                for server in self.servers]
+
+    def away(self):
+        return '/away Detached from screen since then'
+
+
+# scenarios do their steps and return the commands they expect
+
+def detach(sim):
+    """Detached longer than detach_delay: away on every server"""
+    sim.advance(10)
+    sim.detach()
+    sim.advance(30)
+    return sim.each(sim.away())
+
+
+def quick_reattach(sim):
+    """Reattached within detach_delay: nothing is sent"""
+    sim.advance(10)
+    sim.detach()
+    sim.advance(6)
+    sim.attach()
+    sim.advance(30)
+    return []
+
+
+def away_and_back(sim):
+    """Detach, then attach again"""
+    sim.detach()
+    sim.advance(30)
+    sim.attach()
+    sim.advance(30)
+    return sim.each(sim.away()) + sim.each('/away')
+
+
+def suffix(sim):
+    """away_suffix renames on detach and back on attach"""
+    weechat.config_set_plugin('away_suffix', '|away')
+    sim.detach()
+    sim.advance(30)
+    sim.nick('me|away')
+    sim.attach()
+    sim.advance(30)
+    return (sim.each('/nick me|away', sim.away()) +
+            sim.each('/away', '/nick me'))
+
+
+def others_nick(sim):
+    """Nick changes of other users don't scan the server again"""
+    scans = sim.script.PROFILE['server_scan'].total
+    for server in sim.servers:
+        weechat.send_signal('%s,irc_in2_nick' % server,
+                            '@time=x :bob!bob@host NICK :bobby')
+    if sim.script.PROFILE['server_scan'].total != scans:
+        return ['server scanned again']
+    return []
+
+
+def ignored(sim):
+    """Servers in ignore are left alone"""
+    weechat.config_set_plugin('ignore', sim.servers[1])
+    sim.detach()
+    sim.advance(30)
+    return [('buf.' + sim.servers[0], sim.away())]
+
+
+def relay(sim):
+    """A connected relay client keeps you back until it leaves"""
+    sim.relay('0x1', 'connected')
+    sim.detach()
+    sim.advance(30)
+    sim.relay('0x1', 'disconnected')
+    sim.advance(30)
+    return sim.each(sim.away())
+
+
+def relay_flap(sim):
+    """A relay client reconnecting within detach_delay sends nothing"""
+    sim.relay('0x1', 'connected')
+    sim.detach()
+    sim.advance(30)
+    for i in range(5):
+        sim.relay('0x1', 'disconnected')
+        sim.advance(3)
+        sim.relay('0x1', 'connected')
+        sim.advance(3)
+    return []
+
+
+def min_dwell(sim):
+    """min_dwell holds the way back until the away lasted long enough"""
+    weechat.config_set_plugin('min_dwell', '120')
+    sim.detach()
+    sim.advance(30)
+    sim.attach()
+    sim.advance(60)
+    expected = sim.each(sim.away())
+    if weechat.commands != expected:
+        return expected
+    sim.advance(60)
+    return expected + sim.each('/away')
+
+
+def commands_on_attach(sim):
+    """command_on_detach and command_on_attach go to the core buffer,
+    several separated by semicolons"""
+    weechat.config_set_plugin('command_on_detach', '/bye;/later')
+    weechat.config_set_plugin('command_on_attach', '/hello')
+    sim.detach()
+    sim.advance(30)
+    sim.attach()
+    sim.advance(30)
+    return (sim.each(sim.away()) + [('', '/bye'), ('', '/later')] +
+            sim.each('/away') + [('', '/hello')])
+
+
+def nick_only(sim):
+    """set_away off only changes the nick"""
+    weechat.config_set_plugin('set_away', 'off')
+    weechat.config_set_plugin('away_suffix', '|away')
+    sim.detach()
+    sim.advance(30)
+    sim.nick('me|away')
+    sim.attach()
+    sim.advance(30)
+    return sim.each('/nick me|away') + sim.each('/nick me')
+
+
+def mosh(sim):
+    """mosh disconnected counts as detached even with screen attached"""
+    sim.set_mosh('connected')
+    sim.advance(30)
+    sim.set_mosh('disconnected')
+    sim.advance(30)
+    sim.set_mosh('connected')
+    sim.advance(30)
+    return sim.each(sim.away()) + sim.each('/away')
+
+
+def mosh_connected(sim):
+    """A connected mosh doesn't keep you back once tmux detached"""
+    sim.set_mosh('connected')
+    sim.detach()
+    sim.advance(30)
+    return sim.each(sim.away())
+
+
+def mosh_gone(sim):
+    """Without a mosh state file only the socket counts"""
+    sim.set_mosh('disconnected')
+    sim.advance(30)
+    sim.set_mosh(None)
+    sim.advance(30)
+    return sim.each(sim.away()) + sim.each('/away')
+
+
+# control mode output recorded from tmux 3.3a attached with -C and -f
+# ignore-size,no-output,read-only, %layout-change and %window-* lines
+# left out. list-clients -F '#{client_control_mode}' was sent at connect
+# and for every client notification, it prints 1 for control clients and
+# 0 for the others. The reply to the first list-clients came before the
+# %begin/%end of the attach-session the client was started with and was
+# empty, the client not being attached yet.
+TMUX_CONNECT = '''%begin 1792352313 263 1
+%end 1792352313 263 1
+%begin 1792352313 264 0
+%end 1792352313 264 0
+%session-changed $0 main
+%begin 1792352313 269 1
+1
+%end 1792352313 269 1
+'''
+TMUX_ATTACH = '''%client-session-changed /dev/pts/3 $0 main
+%begin 1792352314 276 1
+1
+0
+%end 1792352314 276 1
+'''
+TMUX_DETACH = '''%client-detached /dev/pts/3
+%begin 1792352315 283 1
+1
+%end 1792352315 283 1
+'''
+TMUX_EXIT = '''%sessions-changed
+%exit
+'''
+# connecting while a client was attached, this time attach-session came
+# first
+TMUX_CONNECT_ATTACHED = '''%begin 1792352329 271 0
+%end 1792352329 271 0
+%session-changed $0 main
+%begin 1792352329 275 1
+0
+1
+%end 1792352329 275 1
+%begin 1792352329 276 1
+0
+1
+%end 1792352329 276 1
+'''
+
+
+def tmux_control(sim):
+    """Clients come and go as tmux reports them, the socket is checked
+    again once the control client is gone"""
+    sim.tmux(TMUX_CONNECT)
+    sim.advance(30)
+    sim.tmux(TMUX_ATTACH)
+    sim.advance(30)
+    sim.tmux(TMUX_DETACH)
+    sim.advance(30)
+    sim.detach()
+    sim.tmux(TMUX_EXIT, 0)
+    sim.advance(30)
+    return sim.each(sim.away()) + sim.each('/away') + sim.each(sim.away())
+
+
+tmux_control.options = {'tmux_control': 'on'}
+
+
+def tmux_control_attached(sim):
+    """A client attached when the control client connects, in whatever
+    order the replies come, is never taken for detached"""
+    sim.tmux(TMUX_CONNECT.replace('1\n%end 1792352313 269',
+                                  '0\n1\n%end 1792352313 269'))
+    sim.advance(30)
+    sim.tmux(TMUX_EXIT, 0)
+    # reconnects after a second
+    sim.advance(30)
+    sim.tmux(TMUX_CONNECT_ATTACHED)
+    sim.advance(30)
+    # going away and back at once cancels the commands, but not the
+    # presence signals
+    if sim.script.HISTORY:
+        return ['%s at %d' % (event, when - 1e9)
+                for when, event in sim.script.HISTORY]
+    return []
+
+
+tmux_control_attached.options = {'tmux_control': 'on', 'detach_delay': '0'}
+
+
+SCENARIOS = [detach, quick_reattach, away_and_back, suffix, others_nick,
+             ignored, relay, relay_flap, min_dwell, commands_on_attach,
+             nick_only, mosh, mosh_connected, mosh_gone, tmux_control,
+             tmux_control_attached]
+# run again with inotify on the socket and the mosh state file
+INOTIFY_SCENARIOS = [detach, quick_reattach, away_and_back, min_dwell,
+                     mosh, mosh_connected, mosh_gone]
+
+
+def run_scenarios(directory):
+    failed = 0
+    runs = [(scenario, '', getattr(scenario, 'options', {}))
+            for scenario in SCENARIOS]
+    runs.extend((scenario, ' inotify', {'use_inotify': 'on'})
+                for scenario in INOTIFY_SCENARIOS)
+    for scenario, label, options in runs:
+        sim = Sim(directory, **options)
+        if label and sim.script.INOTIFY_FD is None:
+            expected = ['inotify not in use']
+        else:
+            expected = scenario(sim)
+            sim.advance(60)
+        sim.close()
+        if weechat.commands == expected:
+            print('ok    %s%s' % (scenario.__name__, label))
+        else:
+            failed += 1
+            print('FAIL  %s%s: %s' % (scenario.__name__, label,
+                                      scenario.__doc__))
+            print('      expected %r' % (expected,))
+            print('      got      %r' % (weechat.commands,))
+    return failed
+
+
+def count_calls():
+    """Wraps the weechat API so calls to it are counted in CALLS"""
+    def counted(function):
+        def wrapper(*args):
+            CALLS[0] += 1
+            return function(*args)
+        return wrapper
+    for name in dir(weechat):
+        function = getattr(weechat, name)
+        if callable(function) and not name.startswith(('_', 'reset', 'load',
+                                                         'advance')) and \
+                name[0].islower():
+            setattr(weechat, name, counted(function))
+
+
+def bench(directory, sizes, repeat):
+    print('%7s %10s %10s %14s %12s' % (
+        'servers', 'tick us', 'calls', 'transition us', 'drain s'))
+    for size in sizes:
+        sim = Sim(directory, servers=size, detach_delay='0')
+        script = sim.script
+
+        CALLS[0] = 0
+        start = timer()
+        for _ in range(repeat):
+            script.screen_away_timer_cb('', '')
+        tick = (timer() - start) / repeat * 1e6
+        tick_calls = CALLS[0] // repeat
+
+        transitions = drained = 0.0
+        rounds = max(1, repeat // size)
+        for _ in range(rounds):
+            for away in (True, False):
+                start = timer()
+                script.transition(away)
+                transitions += timer() - start
+                began = weechat.now
+                while script.PENDING:
+                    weechat.advance(0.1)
+                drained += weechat.now - began
+        print('%7d %10.1f %10d %14.1f %12.1f' % (
+            size, tick, tick_calls,
+            transitions / (2 * rounds) * 1e6, drained / (2 * rounds)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1,10,100,500')
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--no-bench', action='store_true',
+                        help='only run the scenarios')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='sim_screen_away')
+    try:
+        failed = run_scenarios(directory)
+        if not args.no_bench and not failed:
+            print('')
+            count_calls()
+            bench(directory, [int(size) for size in args.sizes.split(',')],
+                  args.repeat)
+    finally:
+        shutil.rmtree(directory)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the weechat module used by the benchmarks in this directory.
+
+It implements the part of the scripting API the scripts use, keeps
+buffers, plugin options and hooks in plain module level state, runs
+timers on a virtual clock and fd hooks once their fd is readable, so a
+script can be loaded and driven without WeeChat:
+
+    import weechat
+    script = weechat.load_script('sendmail_notify.py')
+    buf = weechat.add_buffer('freenode', '#weechat', 'channel')
+    weechat.print_line(buf, 'notify_message', '1', '1', 'bob', 'hi')
+    weechat.advance(60)
+"""
+
+import fnmatch
+import heapq
+import itertools
+import select
+
+WEECHAT_RC_OK = 0
+WEECHAT_RC_ERROR = -1
+WEECHAT_HOOK_PROCESS_RUNNING = -1
+WEECHAT_HOOK_PROCESS_ERROR = -2
+WEECHAT_HOOK_SIGNAL_STRING = 'string'
+
+# state of the fake client, reset() puts it back to a fresh start
+plugin_options = {}
+infos = {}
+infolists = {}
+buffers = {}
+hooks = {}
+timers = []
+printed = []
+commands = []
+now = 0.0
+script = None
+_ids = itertools.count(1)
+
+
+def reset():
+    global now, script
+    plugin_options.clear()
+    infos.clear()
+    infolists.clear()
+    buffers.clear()
+    hooks.clear()
+    del timers[:]
+    del printed[:]
+    del commands[:]
+    _hdata_links.clear()
+    now = 0.0
+    script = None
+
+
+def load_script(path, name=None):
+    """Loads a script with this module standing in for weechat. Hooks are
+       resolved against the script that was loading or running a callback
+       when they were made, so several scripts can be loaded together.
+    """
+    global script
+    import os
+    import sys
+    name = name or os.path.splitext(os.path.basename(path))[0]
+    sys.modules['weechat'] = sys.modules[__name__]
+    try:
+        import importlib.util
+    except ImportError:
+        import types
+        script = types.ModuleType(name)
+        script.__file__ = path
+        exec(compile(open(path).read(), path, 'exec'), script.__dict__)
+    else:
+        spec = importlib.util.spec_from_file_location(name, path)
+        script = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(script)
+    return script
+
+
+class Hook(object):
+    def __init__(self, kind, callback, data, **args):
+        self.pointer = '0x%x' % next(_ids)
+        self.kind = kind
+        self.callback = callback
+        self.data = data
+        self.args = args
+        self.settings = {}
+        self.script = script
+        hooks[self.pointer] = self
+
+    def call(self, *args):
+        global script
+        caller, script = script, self.script
+        try:
+            return getattr(script, self.callback)(self.data, *args)
+        finally:
+            script = caller
+
+
+def _hooks(kind):
+    return [hook for hook in list(hooks.values()) if hook.kind == kind]
+
+
+# plugin api
+
+def register(name, author, version, license, description, shutdown_function,
+             charset):
+    return 1
+
+
+def prnt(buffer, message):
+    printed.append(message)
+
+
+def prefix(name):
+    return {'error': '=!=\t'}.get(name, '')
+
+
+def info_get(name, arguments):
+    for hook in _hooks('info'):
+        if hook.args['name'] == name:
+            return hook.call(name, arguments)
+    return infos.get(name, '')
+
+
+def config_get_plugin(option):
+    return plugin_options.get(option, '')
+
+
+def config_set_plugin(option, value):
+    plugin_options[option] = value
+    for hook in _hooks('config'):
+        hook.call('plugins.var.python.%s.%s' % (script.__name__, option),
+                  value)
+    return 1
+
+
+def config_is_set_plugin(option):
+    return option in plugin_options
+
+
+def config_unset_plugin(option):
+    plugin_options.pop(option, None)
+    return 1
+
+
+def config_set_desc_plugin(option, description):
+    pass
+
+
+def config_string_to_boolean(value):
+    return 1 if value.lower() in ('on', 'yes', 'y', 'true', 't', '1') else 0
+
+
+def command(buffer, command):
+    commands.append((buffer, command))
+    return WEECHAT_RC_OK
+
+
+def buffer_get_string(buffer, name):
+    if name.startswith('localvar_'):
+        return buffers.get(buffer, {}).get(name[9:], '')
+    return ''
+
+
+class Infolist(object):
+    def __init__(self, items=None):
+        self.items = items or []
+        self.index = -1
+
+
+def infolist_new():
+    return Infolist()
+
+
+def infolist_new_item(infolist):
+    infolist.items.append({})
+    return infolist.items[-1]
+
+
+def infolist_new_var_string(item, name, value):
+    item[name] = value
+
+
+def infolist_new_var_integer(item, name, value):
+    item[name] = value
+
+
+def infolist_get(name, pointer, arguments):
+    if name == 'option':
+        prefix = 'plugins.var.python.%s.' % script.__name__
+        return Infolist([
+            {'full_name': prefix + option, 'value': value}
+            for option, value in sorted(plugin_options.items())
+            if fnmatch.fnmatchcase(prefix + option, arguments or '*')])
+    # WeeChat copies every item into a new infolist
+    return Infolist([dict(item) for item in infolists.get(name, [])
+                     if not arguments or
+                     fnmatch.fnmatchcase(item.get('name', ''), arguments)])
+
+
+def infolist_next(infolist):
+    infolist.index += 1
+    return 1 if infolist.index < len(infolist.items) else 0
+
+
+def infolist_string(infolist, name):
+    return infolist.items[infolist.index].get(name, '')
+
+
+def infolist_integer(infolist, name):
+    return infolist.items[infolist.index].get(name, 0)
+
+
+def infolist_pointer(infolist, name):
+    return infolist.items[infolist.index].get(name, '')
+
+
+def infolist_free(infolist):
+    pass
+
+
+# hdata lists are served from the same items as the matching infolists
+HDATA_INFOLISTS = {'irc_server': 'irc_server', 'relay_client': 'relay'}
+_hdata_links = {}
+
+
+def _hdata_link(hdata):
+    """Gives every item of a list a pointer, returns {pointer: (item, next
+       pointer)} for the list
+    """
+    items = infolists.get(HDATA_INFOLISTS[hdata], [])
+    key = (id(items), len(items))
+    links = _hdata_links.get(hdata)
+    if links is None or links[0] != key:
+        for item in items:
+            item.setdefault('pointer', '0x%x' % next(_ids))
+        pointers = [item['pointer'] for item in items] + ['']
+        links = _hdata_links[hdata] = (key, dict(
+            (pointer, (item, pointers[index + 1]))
+            for index, (pointer, item) in enumerate(zip(pointers, items))))
+    return links[1]
+
+
+def hdata_get(name):
+    return name if name in HDATA_INFOLISTS else ''
+
+
+def hdata_get_list(hdata, name):
+    items = infolists.get(HDATA_INFOLISTS[hdata], [])
+    if not items:
+        return ''
+    _hdata_link(hdata)
+    return items[0]['pointer']
+
+
+def hdata_move(hdata, pointer, count):
+    for _ in range(count):
+        pointer = _hdata_link(hdata)[pointer][1]
+        if not pointer:
+            break
+    return pointer
+
+
+def hdata_string(hdata, pointer, name):
+    return _hdata_link(hdata)[pointer][0].get(name, '')
+
+
+def hdata_integer(hdata, pointer, name):
+    return _hdata_link(hdata)[pointer][0].get(name, 0)
+
+
+def hdata_pointer(hdata, pointer, name):
+    return _hdata_link(hdata)[pointer][0].get(name, '')
+
+
+def hook_print(buffer, tags, message, strip_colors, callback, data):
+    return Hook('print', callback, data,
+                tags=set(tag for tag in tags.split(',') if tag)).pointer
+
+
+def hook_config(option, callback, data):
+    return Hook('config', callback, data, option=option).pointer
+
+
+def hook_signal(signal, callback, data):
+    return Hook('signal', callback, data, signal=signal).pointer
+
+
+def hook_signal_send(signal, type_data, signal_data):
+    send_signal(signal, signal_data)
+    return WEECHAT_RC_OK
+
+
+def hook_command(command, description, args, args_description, completion,
+                 callback, data):
+    return Hook('command', callback, data, command=command).pointer
+
+
+def hook_info(name, description, args_description, callback, data):
+    return Hook('info', callback, data, name=name).pointer
+
+
+def hook_infolist(name, description, pointer_description,
+                  args_description, callback, data):
+    return Hook('infolist', callback, data, name=name).pointer
+
+
+def hook_timer(interval, align_second, max_calls, callback, data):
+    hook = Hook('timer', callback, data, interval=interval / 1000.0,
+                remaining=max_calls)
+    heapq.heappush(timers, (now + hook.args['interval'], hook.pointer))
+    return hook.pointer
+
+
+def hook_fd(fd, flag_read, flag_write, flag_exception, callback, data):
+    return Hook('fd', callback, data, fd=fd).pointer
+
+
+def hook_process_hashtable(command, options, timeout, callback, data):
+    return Hook('process', callback, data, command=command,
+                options=options).pointer
+
+
+def hook_process(command, timeout, callback, data):
+    return hook_process_hashtable(command, {}, timeout, callback, data)
+
+
+def hook_set(hook, name, value):
+    if hook in hooks:
+        hooks[hook].settings[name] = value
+
+
+def unhook(hook):
+    hooks.pop(hook, None)
+
+
+# driving the fake client
+
+def add_buffer(server, channel, buffer_type, away=''):
+    pointer = '0x%x' % next(_ids)
+    buffers[pointer] = {'server': server, 'channel': channel,
+                        'type': buffer_type}
+    if away:
+        buffers[pointer]['away'] = away
+    return pointer
+
+
+def print_hooks(tags):
+    """Returns the print hooks a line with these tags would reach"""
+    tags = set(tags.split(','))
+    return [hook for hook in _hooks('print')
+            if not hook.args['tags'] or hook.args['tags'] & tags]
+
+
+def print_line(buffer, tags, displayed, highlight, prefix, message):
+    for hook in print_hooks(tags):
+        hook.call(buffer, '0', tags, displayed, highlight, prefix, message)
+
+
+def send_signal(signal, signal_data):
+    for hook in _hooks('signal'):
+        if fnmatch.fnmatchcase(signal, hook.args['signal']):
+            hook.call(signal, signal_data)
+
+
+def _poll_fds():
+    """Runs the fd hooks whose fd is readable"""
+    fds = dict((hook.args['fd'], hook) for hook in _hooks('fd'))
+    if fds:
+        for fd in select.select(list(fds), [], [], 0)[0]:
+            fds[fd].call(fd)
+
+
+def advance(seconds):
+    """Moves the virtual clock forward, running the fd hooks whose fd is
+       readable and then every timer that is due
+    """
+    global now
+    _poll_fds()
+    end = now + seconds
+    while timers and timers[0][0] <= end:
+        when, pointer = heapq.heappop(timers)
+        hook = hooks.get(pointer)
+        if hook is None:
+            continue
+        now = when
+        if hook.args['remaining'] != 1:
+            if hook.args['remaining'] > 1:
+                hook.args['remaining'] -= 1
+            heapq.heappush(timers, (now + hook.args['interval'], pointer))
+        else:
+            unhook(pointer)
+        hook.call(hook.args['remaining'])
+    now = end
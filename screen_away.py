@@ -24,6 +24,29 @@
 # (this script requires WeeChat 0.3.0 or newer)
 #
 # History:
+# 2026-10-18
+#  version 0.15: merge screen_away_mosh.py: mosh provider and mosh_state,
+#                time_format, set_away, commands separated by semicolon,
+#                ignore_relays becomes check_relay
+#                add options presence, detach_delay, attach_delay,
+#                min_dwell, tmux_control, use_inotify, pace_per_server,
+#                pace_total and tick_budget
+#                add screen_away_presence info and signal
+# 2014-08-02, Nils Görs <weechatter@arcor.de>
+#  version 0.14: (screen_away_mosh) add time to detach message.
+#                (idea by Mikaela)
+# 2014-06-19, Anders Bergh <anders1@gmail.com>
+#  version 0.13: (screen_away_mosh) Fix a simple typo in an option
+#                description.
+# 2014-01-12, Phyks (Lucas Verney) <phyks@phyks.me>
+#  version 0.12: (screen_away_mosh) Added an option to check status of
+#                relays to set unaway in case of a connected relay.
+# 2013-08-30, Anders Einar Hilden <hildenae@gmail.com>
+#  version 0.11: (screen_away_mosh) Fix reading of set_away
+# 2013-06-16, Renato Botelho <rbgarga@gmail.com>
+#  version 0.10: (screen_away_mosh) add option to don't set away, only
+#                change nick, allow multiple commands on attach/dettach,
+#                do not add suffix if nick already have it
 # 2013-01-18, Trey Morris <trey@treymorris.com>
 #  version 0.10: check for connected relays as well as screen/tmux
 # 2012-12-29, David Flatz <david@upcs.at>
@@ -51,26 +74,661 @@
 import weechat as w
 import re
 import os
+import pwd
+import ctypes
+import ctypes.util
+import struct
+import time
+from collections import deque, OrderedDict
 
 SCRIPT_NAME = "screen_away"
 SCRIPT_AUTHOR = "xt <xt@bash.no>"
-SCRIPT_VERSION = "0.10"
+SCRIPT_VERSION = "0.15"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC = "Set away status on screen detach"
 
 settings = {
-        'message': ('Detached from screen', 'Away mesage'),
+        'message': ('Detached from screen', 'Away message'),
+        'time_format': ('', 'Time format appended to the away message, '
+                            'like since %Y-%m-%d %H:%M:%S%z'),
         'interval': ('5', 'How often in seconds to check screen status'),
         'away_suffix': ('', 'What to append to your nick when you\'re away.'),
-        'command_on_attach': ('', 'Command to execute on attach'),
-        'command_on_detach': ('', 'Command to execute on detach'),
+        'command_on_attach': ('', 'Commands to execute on attach, separated '
+                                  'by semicolon'),
+        'command_on_detach': ('', 'Commands to execute on detach, separated '
+                                  'by semicolon'),
         'ignore': ('', 'Comma-separated list of servers to ignore.'),
+        'set_away': ('on', 'Set user as away.'),
         'check_relay': ('no', 'Should relays be considered as well?'),
+        'mosh_state': ('/tmp/mosh_state', 'File holding connected while a '
+                                          'mosh client is connected, empty '
+                                          'to not follow mosh'),
+        'pace_per_server': ('2/1', 'Commands sent to one server at most, '
+                                   'as count/seconds'),
+        'pace_total': ('10/1', 'Commands sent to all servers together at '
+                               'most, as count/seconds'),
+        'presence': ('screen&mosh|tmux&mosh|relay', 'When you count as '
+                     'attached: providers joined by & all have to be '
+                     'attached, | separates alternatives, providers without '
+                     'an opinion are left out, and alternatives naming '
+                     'screen or tmux when not running in it. Providers: '
+                     'screen, tmux, mosh, relay'),
+        'detach_delay': ('10', 'Seconds you have to stay detached before '
+                               'being set away'),
+        'attach_delay': ('0', 'Seconds you have to stay attached before the '
+                              'away status is cleared'),
+        'min_dwell': ('0', 'Seconds to stay away or back at least before '
+                           'changing again'),
+        'tmux_control': ('on', 'Follow the clients attached to the tmux '
+                               'session through a tmux control mode '
+                               'connection (tmux >= 3.2) instead of the '
+                               'socket'),
+        'tick_budget': ('0', 'Warn when checking presence takes longer '
+                             'than this many milliseconds, 0 to never '
+                             'warn'),
+        'use_inotify': ('on', 'Watch the screen/tmux socket and mosh '
+                              'state file with inotify instead of checking '
+                              'them every interval seconds'),
 }
 
 TIMER = None
 SOCK = None
 AWAY = False
+SCREEN_LS_TIMEOUT = 10 * 1000
+SCREEN_LS_OUTPUT = []
+INOTIFY_FD = None
+INOTIFY_HOOK = None
+WATCHES = {}
+LIBC = None
+
+# presence providers by name and the presence option compiled into a list
+# of groups of provider names, see is_attached()
+PROVIDERS = OrderedDict()
+PRESENCE_RULE = []
+
+# pointers of connected relay clients, kept up to date by
+# screen_away_relay_cb
+RELAY_CLIENTS = set()
+RELAY_STATUS_CONNECTED = 2
+
+# irc servers by name, kept up to date by screen_away_server_cb, and the
+# options get_servers needs, kept up to date by screen_away_config_cb.
+# NICK_SOURCE finds who changed nick in a NICK message.
+SERVERS = OrderedDict()
+NICK_SOURCE = re.compile(r'^(?:@\S* )?:([^!@ ]+)')
+IGNORES = set()
+AWAY_MESSAGE = ''
+SET_AWAY = True
+
+# commands waiting to be sent by screen_away_scheduler_cb: buffer -> jobs,
+# a job being the commands of one attach or detach for that buffer, PACE
+# holds the pace_* options as (count, seconds)
+PENDING = OrderedDict()
+BUCKETS = {}
+TOTAL_BUCKET = [None, 0.0]
+PACE = {'pace_per_server': (2.0, 1.0), 'pace_total': (10.0, 1.0)}
+SCHEDULER = None
+SCHEDULED = {'sent': 0, 'cancelled': 0}
+
+# the away status check_presence wants to change to once the hold-down
+# time is over, None if there is nothing to change, and the last
+# transitions as (time, event): 'away', 'back' or 'held back'. DELAYS
+# holds the hold-down options in seconds.
+TRANSITION = None
+TRANSITION_TIMER = None
+LAST_TRANSITION = 0.0
+HISTORY = deque(maxlen=100)
+DELAYS = {'detach_delay': 10.0, 'attach_delay': 0.0, 'min_dwell': 0.0}
+
+# what other scripts get from the screen_away_presence info and signal
+PRESENCE = {'state': 'back', 'since': 0, 'source': ''}
+
+# time spent per callback and phase over the last PROFILE_SIZE calls,
+# shown by /screen_away stats, and the tick_budget option in seconds
+PROFILE = OrderedDict()
+PROFILE_SIZE = 1024
+TICK_BUDGET = 0.0
+clock = getattr(time, 'monotonic', time.time)
+
+# inotify(7) event masks
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_IGNORED = 0x8000
+IN_CLOEXEC = 0x80000
+
+
+class Histogram(object):
+    '''Durations of the last PROFILE_SIZE calls counted in buckets of
+    powers of two microseconds. A ring buffer remembers the bucket of each
+    call, so the oldest one can be taken out again when it is replaced.'''
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.ring = [None] * PROFILE_SIZE
+        self.position = 0
+        self.total = 0
+
+    def reset(self):
+        self.__init__()
+
+    def add(self, seconds):
+        bucket = int(seconds * 1000000).bit_length()
+        old = self.ring[self.position]
+        if old is not None:
+            self.buckets[old] -= 1
+        self.ring[self.position] = bucket
+        self.position = (self.position + 1) % PROFILE_SIZE
+        self.buckets[bucket] += 1
+        self.total += 1
+
+    def count(self):
+        return sum(self.buckets)
+
+    def percentile(self, fraction):
+        '''Returns the upper bound in microseconds of the bucket holding
+        the given fraction of the durations'''
+        total = fraction * self.count()
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= total:
+                return 1 << bucket
+        return 0
+
+
+def profiled(name, tick=False):
+    '''Decorator timing each call into PROFILE[name]. A tick is a callback
+    that checks presence, one taking longer than tick_budget warns.'''
+
+    histogram = PROFILE.setdefault(name, Histogram())
+
+    def decorator(function):
+        def wrapper(*args):
+            start = clock()
+            try:
+                return function(*args)
+            finally:
+                elapsed = clock() - start
+                histogram.add(elapsed)
+                if tick and TICK_BUDGET and elapsed > TICK_BUDGET:
+                    w.prnt('', '%s%s: %s took %.2fms, budget is %gms' %
+                           (w.prefix('error'), SCRIPT_NAME, name,
+                            elapsed * 1000, TICK_BUDGET * 1000))
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+def load_tick_budget():
+    global TICK_BUDGET
+    try:
+        TICK_BUDGET = float(w.config_get_plugin('tick_budget')) / 1000
+    except ValueError:
+        TICK_BUDGET = 0.0
+
+
+def screen_away_cmd(data, buffer, args):
+    '''Callback for /screen_away'''
+
+    args = args.split()
+    if args == ['stats']:
+        w.prnt(buffer, '%s: %s, last %d calls each' %
+               (SCRIPT_NAME, 'away' if AWAY else 'back', PROFILE_SIZE))
+        for name, histogram in PROFILE.items():
+            if not histogram.total:
+                continue
+            w.prnt(buffer, '%s: %s: calls %d, p50 <%dus, p99 <%dus, '
+                   'max <%dus' % (SCRIPT_NAME, name, histogram.total,
+                                  histogram.percentile(0.5),
+                                  histogram.percentile(0.99),
+                                  histogram.percentile(1)))
+    elif args == ['stats', 'reset']:
+        for histogram in PROFILE.values():
+            histogram.reset()
+    else:
+        return w.WEECHAT_RC_ERROR
+    return w.WEECHAT_RC_OK
+
+
+class Provider(object):
+    '''A source of presence. present() is True for attached, False for
+    detached and None for no opinion. It is only evaluated again after the
+    provider was marked dirty because its input changed: by inotify or
+    signals, or on every timer tick for polled providers.'''
+
+    polled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.dirty = True
+        self.value = None
+
+    def watches(self):
+        '''inotify watches as (path, mask, name), events for a directory
+        only count if they are about the file called name'''
+        return []
+
+    def evaluate(self):
+        return None
+
+    def stop(self):
+        pass
+
+    def present(self):
+        if self.dirty:
+            self.value = self.evaluate()
+            self.dirty = False
+        return self.value
+
+
+class SocketProvider(Provider):
+    '''screen and tmux set the X bit of their socket while a client is
+    attached'''
+
+    def __init__(self, name, path):
+        Provider.__init__(self, name)
+        self.path = path
+
+    def watches(self):
+        return [(self.path, IN_ATTRIB | IN_DELETE_SELF, None)]
+
+    def evaluate(self):
+        return os.access(self.path, os.X_OK)
+
+
+class TmuxControlProvider(Provider):
+    '''Counts the clients attached to our tmux session with a tmux control
+    mode client that stays connected, asking list-clients again whenever
+    tmux notifies about clients. While that connection is down the X bit
+    of the socket is polled instead.'''
+
+    def __init__(self, name, path, session):
+        Provider.__init__(self, name)
+        self.path = path
+        self.session = session
+        self.hook = None
+        self.timer = None
+        self.delay = 1
+        self.clients = None
+        self.polled = True
+        self.line = ''
+        self.replies = deque()
+        self.reply = None
+
+    def connect(self):
+        self.timer = None
+        self.line = ''
+        self.replies = deque()
+        self.reply = None
+        # the control client itself attaches to the session, the flags
+        # keep it from resizing windows or receiving pane output
+        args = ['-S', self.path, '-C', 'attach-session',
+                '-f', 'ignore-size,no-output,read-only',
+                '-t', '$' + self.session]
+        options = dict(('arg%d' % (i + 1), arg) for i, arg in enumerate(args))
+        options['stdin'] = '1'
+        options['buffer_flush'] = '1'
+        self.hook = w.hook_process_hashtable('tmux', options, 0,
+                                             "screen_away_tmux_cb", '')
+        self.send('list-clients')
+
+    def send(self, command):
+        if command == 'list-clients':
+            command = "list-clients -t '$%s' -F '#{client_control_mode}'" % \
+                self.session
+            self.replies.append('list-clients')
+        w.hook_set(self.hook, 'stdin', command + '\n')
+
+    def output(self, data):
+        lines = (self.line + data).split('\n')
+        self.line = lines.pop()
+        for line in lines:
+            line = line.rstrip('\r')
+            if line.startswith('%begin '):
+                self.reply = []
+            elif line.startswith(('%end ', '%error ')):
+                # flags 1 marks the replies to commands we sent, the
+                # attach-session tmux was started with may come before or
+                # after the first of them
+                if line.split()[-1] == '1' and \
+                        self.replies.popleft() == 'list-clients' and \
+                        line.startswith('%end ') and self.reply:
+                    # control clients, this one included, don't count. The
+                    # reply is empty if it came before this one attached.
+                    self.got_clients(len([client for client in self.reply
+                                          if client.strip() == '0']))
+                self.reply = None
+            elif self.reply is not None:
+                self.reply.append(line)
+            elif line.startswith(('%client-session-changed ',
+                                  '%client-detached ', '%sessions-changed',
+                                  '%session-changed ')):
+                self.send('list-clients')
+
+    def got_clients(self, clients):
+        self.delay = 1
+        if clients != self.clients:
+            if self.clients is None:
+                # the socket needs no watching anymore
+                self.clients = clients
+                start_watching()
+            self.clients = clients
+            self.polled = False
+            self.dirty = True
+            check_presence()
+
+    def ended(self):
+        '''The control client is gone, poll the socket and reconnect'''
+        self.hook = None
+        self.clients = None
+        self.polled = self.dirty = True
+        self.timer = w.hook_timer(self.delay * 1000, 0, 1,
+                                  "screen_away_tmux_reconnect_cb", '')
+        self.delay = min(self.delay * 2, 60)
+        start_watching()
+        check_presence()
+
+    def stop(self):
+        if self.hook:
+            w.unhook(self.hook)
+        if self.timer:
+            w.unhook(self.timer)
+        self.hook = self.timer = None
+
+    def watches(self):
+        if self.clients is None:
+            return [(self.path, IN_ATTRIB | IN_DELETE_SELF, None)]
+        return []
+
+    def evaluate(self):
+        if self.clients is None:
+            return os.access(self.path, os.X_OK)
+        return self.clients > 0
+
+
+@profiled('tmux_cb', tick=True)
+def screen_away_tmux_cb(data, command, return_code, out, err):
+    provider = PROVIDERS.get('tmux')
+    if not isinstance(provider, TmuxControlProvider):
+        return w.WEECHAT_RC_OK
+    if out:
+        provider.output(out)
+    if return_code != w.WEECHAT_HOOK_PROCESS_RUNNING:
+        provider.ended()
+    return w.WEECHAT_RC_OK
+
+
+def screen_away_tmux_reconnect_cb(data, remaining_calls):
+    provider = PROVIDERS.get('tmux')
+    if isinstance(provider, TmuxControlProvider):
+        provider.connect()
+    return w.WEECHAT_RC_OK
+
+
+class RelayProvider(Provider):
+    '''Connected relay clients, see screen_away_relay_cb. No opinion when
+    relays are not checked.'''
+
+    polled = False
+
+    def evaluate(self):
+        if w.config_get_plugin('check_relay') != 'yes':
+            return None
+        return relay_attached()
+
+
+class MoshProvider(Provider):
+    '''mosh writes connected to its state file while a client is
+    connected. The file is only read again once its inode, mtime or size
+    changed, a missing file means no opinion.'''
+
+    def __init__(self, name, path):
+        Provider.__init__(self, name)
+        self.path = path
+        self.stat = None
+        self.state = None
+
+    def watches(self):
+        if not self.path:
+            return []
+        # the state file may not exist yet, so its directory is watched
+        return [(os.path.dirname(self.path),
+                 IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE,
+                 os.path.basename(self.path))]
+
+    def evaluate(self):
+        if not self.path:
+            return None
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.stat = self.state = None
+            return None
+        key = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if key != self.stat:
+            self.stat = key
+            try:
+                with open(self.path) as f:
+                    self.state = f.read() == 'connected'
+            except IOError:
+                self.state = None
+        return self.state
+
+
+def load_mosh_provider():
+    '''Follow the file the mosh_state option names, without one mosh has
+    no opinion'''
+
+    PROVIDERS['mosh'] = MoshProvider('mosh', w.config_get_plugin('mosh_state'))
+
+
+def compile_presence_rule():
+    '''Groups naming a provider that isn't there, like screen when weechat
+    runs in tmux, are left out'''
+
+    global PRESENCE_RULE
+    groups = [[name.strip() for name in group.split('&') if name.strip()]
+              for group in w.config_get_plugin('presence').split('|')]
+    PRESENCE_RULE = [group for group in groups
+                     if group and all(name in PROVIDERS for name in group)]
+
+
+def presence_label():
+    '''Names the providers of the presence rule for messages, like
+    Screen/tmux/relay'''
+
+    names = []
+    for group in PRESENCE_RULE:
+        names.extend(name for name in group if name not in names)
+    # only the ones with an opinion, if any has one
+    names = [name for name in names
+             if PROVIDERS[name].value is not None] or names
+    return '/'.join(names).capitalize()
+
+
+@profiled('presence')
+def is_attached():
+    '''Returns True if one group of the presence rule is attached: a group
+    is attached if all its providers with an opinion are, and at least one
+    has an opinion'''
+
+    for group in PRESENCE_RULE:
+        values = [PROVIDERS[name].present() for name in group]
+        values = [value for value in values if value is not None]
+        if values and all(values):
+            return True
+    return False
+
+
+def screen_dirs():
+    '''Directories screen may keep its sockets in, like screen itself
+    picks them: SCREENDIR if set, else the compiled in defaults'''
+
+    if os.environ.get('SCREENDIR'):
+        return [os.environ['SCREENDIR']]
+    user = 'S-' + pwd.getpwuid(os.getuid()).pw_name
+    return [os.path.join(base, user) for base in
+            ('/run/screen', '/var/run/screen', '/tmp/screens',
+             '/tmp/uscreens')] + [os.path.expanduser('~/.screen')]
+
+
+def socket_cache_path():
+    '''File remembering the screen socket of each STY screen -ls found'''
+
+    directory = w.info_get('weechat_cache_dir', '') or \
+        w.info_get('weechat_dir', '')
+    if directory:
+        return os.path.join(directory, 'screen_away_sockets')
+
+
+def read_socket_cache():
+    '''Returns the cached sockets as a dict STY -> path'''
+
+    cache = {}
+    path = socket_cache_path()
+    if not path:
+        return cache
+    try:
+        with open(path) as f:
+            for line in f:
+                sty, _, sock = line.rstrip('\n').partition('\t')
+                if sock:
+                    cache[sty] = sock
+    except IOError:
+        pass
+    return cache
+
+
+def write_socket_cache(sty, sock):
+    '''Remember the socket of a STY, forgetting sockets that are gone'''
+
+    path = socket_cache_path()
+    if not path:
+        return
+    cache = dict((key, value) for key, value in read_socket_cache().items()
+                 if os.path.exists(value))
+    cache[sty] = sock
+    try:
+        with open(path + '.tmp', 'w') as f:
+            for key, value in sorted(cache.items()):
+                f.write('%s\t%s\n' % (key, value))
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        pass
+
+
+def screen_socket():
+    '''Returns the socket of our screen session if it can be found
+    without running screen -ls, else None'''
+
+    sty = os.environ['STY']
+    candidates = [read_socket_cache().get(sty)]
+    candidates.extend(os.path.join(directory, sty)
+                      for directory in screen_dirs())
+    for path in candidates:
+        if path and os.path.exists(path):
+            return path
+
+
+def tmux_socket():
+    if 'TMUX' in os.environ.keys():
+        socket_data = os.environ['TMUX']
+        return socket_data.rsplit(',', 2)[0]
+
+
+def socket_provider(name, sock):
+    '''Returns the provider following the screen or tmux socket sock'''
+
+    if name == 'tmux' and \
+            w.config_string_to_boolean(w.config_get_plugin('tmux_control')):
+        provider = TmuxControlProvider(name, sock,
+                                       os.environ['TMUX'].rsplit(',', 2)[2])
+        provider.connect()
+        return provider
+    return SocketProvider(name, sock)
+
+
+def find_socket():
+    '''Returns the provider name and socket path of the screen or tmux
+    session weechat runs in, (None, None) if there is none. The path is
+    None for a screen session screen -ls has to be asked about.'''
+
+    if 'STY' in os.environ.keys():
+        # We are running under screen
+        return 'screen', screen_socket()
+
+    if 'TMUX' in os.environ.keys():
+        # We are running under tmux
+        return 'tmux', tmux_socket()
+    return None, None
+
+
+def screen_ls_cb(data, command, return_code, out, err):
+    '''Collect the output of screen -ls, start once it is done'''
+
+    SCREEN_LS_OUTPUT.append(out)
+    if return_code == w.WEECHAT_HOOK_PROCESS_RUNNING:
+        return w.WEECHAT_RC_OK
+
+    output = ''.join(SCREEN_LS_OUTPUT)
+    del SCREEN_LS_OUTPUT[:]
+    match = re.search(r'Sockets? in (/.+)\.', output)
+    if match:
+        sock = os.path.join(match.group(1), os.environ['STY'])
+        write_socket_cache(os.environ['STY'], sock)
+        start('screen', sock)
+    else:
+        if return_code == w.WEECHAT_HOOK_PROCESS_ERROR:
+            w.prnt('', '%s%s: screen -ls failed or timed out' %
+                   (w.prefix('error'), SCRIPT_NAME))
+        sock = tmux_socket()
+        if sock:
+            start('tmux', sock)
+    return w.WEECHAT_RC_OK
+
+
+def start(name, sock):
+    '''Start watching the screen or tmux socket sock'''
+
+    global SOCK
+    SOCK = sock
+    PROVIDERS[name] = socket_provider(name, SOCK)
+    PROVIDERS['relay'] = RelayProvider('relay')
+    load_mosh_provider()
+    compile_presence_rule()
+    start_watching()
+    if not TIMER:
+        # first check once servers had time to connect
+        w.hook_timer(int(w.config_get_plugin('interval')) * 1000,
+                0, 1, "screen_away_timer_cb", '')
+    seed_relays()
+    load_server_config()
+    load_servers()
+    for signal in ('irc_server_connected', 'irc_server_disconnected',
+                   '*,irc_in2_305', '*,irc_in2_306', '*,irc_in2_nick'):
+        w.hook_signal(signal, "screen_away_server_cb", "")
+    for signal in ('relay_client_connected', 'relay_client_auth_ok',
+                   'relay_client_auth_failed',
+                   'relay_client_disconnected'):
+        w.hook_signal(signal, "screen_away_relay_cb", "")
+    w.hook_config("plugins.var.python." + SCRIPT_NAME + ".*",
+        "screen_away_config_cb", "")
+    w.hook_info('screen_away_presence',
+                'Presence as state=away|back,since=<unix time>,'
+                'source=<providers joined with + or &>, also sent with the '
+                'screen_away_presence signal when it changes',
+                'state, since or source (optional)',
+                'screen_away_presence_info_cb', '')
+    PRESENCE['since'] = int(time.time())
+    # scripts loaded before us learn that presence is known now
+    w.hook_signal_send('screen_away_presence', w.WEECHAT_HOOK_SIGNAL_STRING,
+                       format_presence())
 
 
 def set_timer():
@@ -83,108 +741,546 @@ def set_timer():
             0, 0, "screen_away_timer_cb", '')
 
 
+def start_watching():
+    '''Watch for attach/detach with inotify, or with the timer if inotify
+    is turned off or not available'''
+
+    global TIMER
+    if w.config_string_to_boolean(w.config_get_plugin('use_inotify')) and \
+            start_inotify():
+        if TIMER:
+            w.unhook(TIMER)
+            TIMER = None
+    else:
+        stop_inotify()
+        set_timer()
+
+
+def start_inotify():
+    '''Set up inotify watches and a fd hook for them, returns False if
+    that is not possible'''
+
+    global INOTIFY_FD, INOTIFY_HOOK, LIBC
+    stop_inotify()
+    try:
+        if LIBC is None:
+            LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = LIBC.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return False
+    if fd < 0:
+        return False
+    for provider in PROVIDERS.values():
+        for path, mask, name in provider.watches():
+            if not isinstance(path, bytes):
+                path = path.encode('utf-8')
+            wd = LIBC.inotify_add_watch(fd, path, mask)
+            if wd < 0:
+                os.close(fd)
+                WATCHES.clear()
+                return False
+            if name is not None and not isinstance(name, bytes):
+                name = name.encode('utf-8')
+            WATCHES[wd] = (name, provider)
+    INOTIFY_FD = fd
+    INOTIFY_HOOK = w.hook_fd(fd, 1, 0, 0, "screen_away_inotify_cb", '')
+    return True
+
+
+def stop_inotify():
+    global INOTIFY_FD, INOTIFY_HOOK
+    if INOTIFY_HOOK:
+        w.unhook(INOTIFY_HOOK)
+        INOTIFY_HOOK = None
+    if INOTIFY_FD is not None:
+        os.close(INOTIFY_FD)
+        INOTIFY_FD = None
+    WATCHES.clear()
+
+
+@profiled('inotify_cb', tick=True)
+def screen_away_inotify_cb(data, fd):
+    '''Read pending inotify events, check attachment only if one of them
+    is about a watched file, not for others in a watched directory'''
+
+    lost = changed = False
+    while True:
+        try:
+            events = os.read(INOTIFY_FD, 4096)
+        except OSError:
+            break
+        if not events:
+            break
+        offset = 0
+        while offset < len(events):
+            wd, mask, cookie, length = struct.unpack_from('iIII', events,
+                                                          offset)
+            name = events[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if mask & IN_IGNORED:
+                # the watched file is gone, watch it again below
+                lost = True
+            elif wd in WATCHES and WATCHES[wd][0] in (None, name):
+                WATCHES[wd][1].dirty = True
+                changed = True
+
+    if lost:
+        start_watching()
+        for provider in PROVIDERS.values():
+            provider.dirty = True
+    if lost or changed:
+        check_presence()
+    return w.WEECHAT_RC_OK
+
+
+@profiled('relay_scan')
+def seed_relays():
+    '''Find the relay clients connected when the script is loaded'''
+
+    RELAY_CLIENTS.clear()
+    hdata = w.hdata_get('relay_client')
+    if not hdata:
+        return
+    client = w.hdata_get_list(hdata, 'relay_clients')
+    while client:
+        if w.hdata_integer(hdata, client, 'status') == RELAY_STATUS_CONNECTED:
+            RELAY_CLIENTS.add(client)
+        client = w.hdata_move(hdata, client, 1)
+
+
+def relay_attached():
+    '''Returns True if a relay client is connected else False'''
+    return bool(RELAY_CLIENTS)
+
+
+@profiled('relay_cb', tick=True)
+def screen_away_relay_cb(data, signal, signal_data):
+    '''Track connected relay clients, check attachment as soon as one
+    comes or goes'''
+
+    if signal in ('relay_client_connected', 'relay_client_auth_ok'):
+        RELAY_CLIENTS.add(signal_data)
+    else:
+        RELAY_CLIENTS.discard(signal_data)
+    PROVIDERS['relay'].dirty = True
+    check_presence()
+    return w.WEECHAT_RC_OK
+
+
 def screen_away_config_cb(data, option, value):
-    if option.endswith(".interval"):
+    if option.endswith(('.ignore', '.message', '.set_away')):
+        load_server_config()
+    elif option.endswith(".interval") and not INOTIFY_FD:
         set_timer()
+    elif option.endswith(".use_inotify"):
+        start_watching()
+    elif option.endswith(".tmux_control") and 'tmux' in PROVIDERS:
+        PROVIDERS['tmux'].stop()
+        PROVIDERS['tmux'] = socket_provider('tmux', SOCK)
+        start_watching()
+        check_presence()
+    elif option.endswith(".tick_budget"):
+        load_tick_budget()
+    elif option.endswith(('.pace_per_server', '.pace_total')):
+        load_pace()
+    elif option.endswith(('.detach_delay', '.attach_delay', '.min_dwell')):
+        load_delays()
+    elif option.endswith(".presence"):
+        compile_presence_rule()
+        check_presence()
+    elif option.endswith('.check_relay'):
+        PROVIDERS['relay'].dirty = True
+        check_presence()
+    elif option.endswith('.mosh_state'):
+        load_mosh_provider()
+        start_watching()
+        check_presence()
     return w.WEECHAT_RC_OK
 
 
+@profiled('server_list')
 def get_servers():
     '''Get the servers that are not away, or were set away by this script'''
 
-    ignores = w.config_get_plugin('ignore').split(',')
-    infolist = w.infolist_get('irc_server', '', '')
     buffers = []
-    while w.infolist_next(infolist):
-        if not w.infolist_integer(infolist, 'is_connected') == 1 or \
-               w.infolist_string(infolist, 'name') in ignores:
+    for name, server in SERVERS.items():
+        if not server['is_connected'] or name in IGNORES:
             continue
-        if not w.infolist_integer(infolist, 'is_away') or \
-               w.infolist_string(infolist, 'away_message') == \
-               w.config_get_plugin('message'):
-            buffers.append((w.infolist_pointer(infolist, 'buffer'),
-                w.infolist_string(infolist, 'nick')))
-    w.infolist_free(infolist)
+        # with time_format the away message starts with AWAY_MESSAGE
+        if not SET_AWAY or not server['is_away'] or \
+                server['away_message'].startswith(AWAY_MESSAGE):
+            buffers.append((server['buffer'], server['nick']))
     return buffers
 
 
-def relay_attached():
-    '''Returns True if relay is attached else False'''
-    # get infolist for relay
-    infolist = w.infolist_get('relay', '', '')
+@profiled('server_scan')
+def load_servers(name=None):
+    '''Read the state of one server, or all of them, into SERVERS'''
+
+    hdata = w.hdata_get('irc_server')
+    if not hdata:
+        return
+    if name is None:
+        SERVERS.clear()
+    server = w.hdata_get_list(hdata, 'irc_servers')
+    while server:
+        server_name = w.hdata_string(hdata, server, 'name')
+        if name is None or server_name == name:
+            SERVERS[server_name] = {
+                'is_connected': w.hdata_integer(hdata, server,
+                                                'is_connected') == 1,
+                'is_away': w.hdata_integer(hdata, server, 'is_away'),
+                'away_message': w.hdata_string(hdata, server, 'away_message'),
+                'buffer': w.hdata_pointer(hdata, server, 'buffer'),
+                'nick': w.hdata_string(hdata, server, 'nick'),
+            }
+            if name is not None:
+                break
+        server = w.hdata_move(hdata, server, 1)
+
+
+def load_server_config():
+    '''Cache the options get_servers needs'''
+
+    global IGNORES, AWAY_MESSAGE, SET_AWAY
+    IGNORES = set(w.config_get_plugin('ignore').split(','))
+    AWAY_MESSAGE = w.config_get_plugin('message')
+    SET_AWAY = w.config_string_to_boolean(w.config_get_plugin('set_away'))
+
+
+@profiled('server_cb')
+def screen_away_server_cb(data, signal, signal_data):
+    '''Update SERVERS when a server connects or disconnects, goes away or
+    comes back or changes nick'''
+
+    if signal == 'irc_server_disconnected':
+        if signal_data in SERVERS:
+            SERVERS[signal_data]['is_connected'] = False
+    elif signal == 'irc_server_connected':
+        load_servers(signal_data)
+    else:
+        # <server>,irc_in2_<command>
+        name, command = signal.split(',', 1)
+        if command == 'irc_in2_nick' and name in SERVERS:
+            # only our own nick changes matter, not everybody else's
+            match = NICK_SOURCE.match(signal_data)
+            if not match or match.group(1) != SERVERS[name]['nick']:
+                return w.WEECHAT_RC_OK
+        load_servers(name)
+    return w.WEECHAT_RC_OK
+
+
+def parse_rate(option):
+    '''Parses a count/seconds option into (count, seconds)'''
+
+    value = w.config_get_plugin(option)
+    try:
+        count, seconds = value.split('/')
+        count, seconds = float(count), float(seconds)
+    except ValueError:
+        raise ValueError('not count/seconds')
+    if count < 1 or seconds <= 0:
+        raise ValueError('count must be at least 1 and seconds above 0')
+    return count, seconds
+
 
-    # only need to look at the first status (current or most recent)
-    w.infolist_next(infolist)
+def load_pace():
+    '''Cache the pace_* options, keeping the last valid value of one that
+    doesn't parse'''
 
-    # status can be connected connecting or disconnected
-    connected = w.infolist_string(infolist, 'status_string') == 'connected'
+    for option in PACE:
+        try:
+            PACE[option] = parse_rate(option)
+        except ValueError as e:
+            w.prnt('', '%s%s: invalid %s |%s|: %s' %
+                   (w.prefix('error'), SCRIPT_NAME, option,
+                    w.config_get_plugin(option), e))
 
-    # have to free infolist since it isn't done automatically
-    w.infolist_free(infolist)
 
-    return connected
+def take_token(bucket, rate, now):
+    '''Token bucket holding up to count tokens and refilling count tokens
+    per seconds. bucket is [tokens, last update], tokens None when new.'''
 
+    count, seconds = rate
+    if bucket[0] is None:
+        bucket[0] = count
+    else:
+        bucket[0] = min(count, bucket[0] + (now - bucket[1]) * count / seconds)
+    bucket[1] = now
+    if bucket[0] < 1:
+        return False
+    bucket[0] -= 1
+    return True
 
+
+def schedule(buffer, kind, commands):
+    '''Queue the commands of an attach or detach for a buffer. An attach
+    cancels a detach of the same buffer nothing was sent for yet, and the
+    other way around.'''
+
+    global SCHEDULER
+    jobs = PENDING.get(buffer)
+    if jobs and not jobs[-1]['started'] and jobs[-1]['kind'] != kind:
+        jobs.pop()
+        SCHEDULED['cancelled'] += 1
+        if not jobs:
+            del PENDING[buffer]
+        return
+    if not commands:
+        return
+    PENDING.setdefault(buffer, deque()).append(
+        {'kind': kind, 'commands': deque(commands), 'started': False})
+    if not SCHEDULER:
+        SCHEDULER = w.hook_timer(100, 0, 0, "screen_away_scheduler_cb", '')
+
+
+@profiled('dispatch')
+def screen_away_scheduler_cb(data, remaining_calls):
+    '''Send pending commands as the per server and total rates allow,
+    taking turns between servers'''
+
+    global SCHEDULER
+    now = time.time()
+    per_server = PACE['pace_per_server']
+    total = PACE['pace_total']
+    progress = True
+    while PENDING and progress:
+        progress = False
+        for buffer in list(PENDING):
+            if not take_token(BUCKETS.setdefault(buffer, [None, now]),
+                              per_server, now):
+                continue
+            if not take_token(TOTAL_BUCKET, total, now):
+                # give the server its token back, it didn't get to send
+                BUCKETS[buffer][0] += 1
+                progress = False
+                break
+            jobs = PENDING[buffer]
+            jobs[0]['started'] = True
+            w.command(buffer, jobs[0]['commands'].popleft())
+            SCHEDULED['sent'] += 1
+            progress = True
+            if not jobs[0]['commands']:
+                jobs.popleft()
+                if not jobs:
+                    del PENDING[buffer]
+
+    if not PENDING:
+        w.unhook(SCHEDULER)
+        SCHEDULER = None
+        w.prnt('', '%s: sent %d commands, %d attach/detach cancelled out' %
+               (SCRIPT_NAME, SCHEDULED['sent'], SCHEDULED['cancelled']))
+        SCHEDULED['sent'] = SCHEDULED['cancelled'] = 0
+    return w.WEECHAT_RC_OK
+
+
+@profiled('timer_cb', tick=True)
 def screen_away_timer_cb(buffer, args):
     '''Check if screen is attached, update awayness'''
 
-    global AWAY, SOCK
+    for provider in PROVIDERS.values():
+        if provider.polled:
+            provider.dirty = True
+    return check_presence()
 
-    suffix = w.config_get_plugin('away_suffix')
-    attached = os.access(SOCK, os.X_OK)  # X bit indicates attached
 
-    if w.config_get_plugin('check_relay') == 'yes':
-        relay = relay_attached()
-        attached = attached or relay
+def load_delays():
+    '''Cache detach_delay, attach_delay and min_dwell, keeping the last
+    valid value of one that doesn't parse'''
+
+    for option in DELAYS:
+        value = w.config_get_plugin(option)
+        try:
+            seconds = float(value or 0)
+            if seconds < 0:
+                raise ValueError('must not be negative')
+            DELAYS[option] = seconds
+        except ValueError as e:
+            w.prnt('', '%s%s: invalid %s |%s|: %s' %
+                   (w.prefix('error'), SCRIPT_NAME, option, value, e))
+
+
+def check_presence():
+    '''Update awayness from the presence providers. A change only happens
+    once presence stayed changed for detach_delay or attach_delay seconds
+    and the current state lasted min_dwell seconds, a change reverted
+    before that is cancelled.'''
+
+    global TRANSITION, TRANSITION_TIMER
+
+    away = not is_attached()
+    if away == AWAY:
+        if TRANSITION is not None:
+            # flapped back before anything was sent
+            HISTORY.append((time.time(), 'held back'))
+            TRANSITION = None
+            w.unhook(TRANSITION_TIMER)
+            TRANSITION_TIMER = None
+        return w.WEECHAT_RC_OK
+    if TRANSITION is not None:
+        # already waiting for this change
+        return w.WEECHAT_RC_OK
+
+    now = time.time()
+    delay = DELAYS['detach_delay' if away else 'attach_delay']
+    due = max(now + delay, LAST_TRANSITION + DELAYS['min_dwell'])
+    if due <= now:
+        transition(away)
+    else:
+        TRANSITION = away
+        TRANSITION_TIMER = w.hook_timer(max(int((due - now) * 1000), 1), 0,
+                                        1, "screen_away_transition_cb", '')
+    return w.WEECHAT_RC_OK
+
+
+@profiled('transition_cb', tick=True)
+def screen_away_transition_cb(data, remaining_calls):
+    '''The hold-down time of a change is over'''
+
+    global TRANSITION, TRANSITION_TIMER
+    away = TRANSITION
+    TRANSITION = TRANSITION_TIMER = None
+    if away is not None and away == (not is_attached()):
+        transition(away)
+    return w.WEECHAT_RC_OK
+
+
+def held_back():
+    '''Returns how many changes were held back since the last one that
+    went through'''
+
+    count = 0
+    for when, event in reversed(HISTORY):
+        if event != 'held back':
+            break
+        count += 1
+    return count
+
 
-    if attached and AWAY:
-        w.prnt('', '%s: Screen/tmux/relay attached. '
-                   'Clearing away status' % SCRIPT_NAME)
+def presence_source(away):
+    '''Returns the providers that made you away or back: the ones that
+    said detached, or the first group that said attached'''
+
+    if away:
+        return '+'.join(name for name, provider in PROVIDERS.items()
+                        if provider.value is False)
+    for group in PRESENCE_RULE:
+        values = [(name, PROVIDERS[name].value) for name in group]
+        names = [name for name, value in values if value is not None]
+        if names and all(value for name, value in values
+                         if value is not None):
+            return '&'.join(names)
+    return ''
+
+
+def format_presence():
+    return 'state=%(state)s,since=%(since)d,source=%(source)s' % PRESENCE
+
+
+def publish_presence(away):
+    '''Tell other scripts about a transition through the
+    screen_away_presence signal'''
+
+    PRESENCE.update(state='away' if away else 'back', since=int(time.time()),
+                    source=presence_source(away))
+    w.hook_signal_send('screen_away_presence', w.WEECHAT_HOOK_SIGNAL_STRING,
+                       format_presence())
+
+
+def screen_away_presence_info_cb(data, info_name, arguments):
+    if arguments:
+        return str(PRESENCE.get(arguments, ''))
+    return format_presence()
+
+
+def screen_away_unload_cb():
+    '''Presence is unknown once the script is gone'''
+
+    PRESENCE.update(state='unknown', since=int(time.time()), source='')
+    w.hook_signal_send('screen_away_presence', w.WEECHAT_HOOK_SIGNAL_STRING,
+                       format_presence())
+    return w.WEECHAT_RC_OK
+
+
+@profiled('transition')
+def transition(away):
+    '''Set or clear the away status on all servers'''
+
+    global AWAY, LAST_TRANSITION
+
+    suffix = w.config_get_plugin('away_suffix')
+    held = held_back()
+    if held:
+        w.prnt('', '%s: %d flapping attach/detach held back' %
+               (SCRIPT_NAME, held))
+    LAST_TRANSITION = time.time()
+    HISTORY.append((LAST_TRANSITION, 'away' if away else 'back'))
+
+    if not away:
+        w.prnt('', '%s: %s attached. Clearing away status' %
+               (SCRIPT_NAME, presence_label()))
         for server, nick in get_servers():
-            w.command(server,  "/away")
+            commands = []
+            if SET_AWAY:
+                commands.append("/away")
             if suffix and nick.endswith(suffix):
                 nick = nick[:-len(suffix)]
-                w.command(server,  "/nick %s" % nick)
+                commands.append("/nick %s" % nick)
+            schedule(server, 'attach', commands)
         AWAY = False
-        if w.config_get_plugin("command_on_attach"):
-            w.command("", w.config_get_plugin("command_on_attach"))
+        schedule("", 'attach', [cmd for cmd in w.config_get_plugin(
+            "command_on_attach").split(";") if cmd])
 
-    elif not attached and not AWAY:
-        w.prnt('', '%s: Screen/tmux/relay detached. '
-                   'Setting away status' % SCRIPT_NAME)
+    else:
+        w.prnt('', '%s: %s detached. Setting away status' %
+               (SCRIPT_NAME, presence_label()))
+        message = w.config_get_plugin('message')
+        time_format = w.config_get_plugin('time_format')
+        if time_format:
+            message = '%s %s' % (message, time.strftime(time_format))
         for server, nick in get_servers():
-            if suffix:
-                w.command(server, "/nick %s%s" % (nick, suffix))
-            w.command(server, "/away %s" % w.config_get_plugin('message'))
+            commands = []
+            if suffix and not nick.endswith(suffix):
+                commands.append("/nick %s%s" % (nick, suffix))
+            if SET_AWAY:
+                commands.append("/away %s" % message)
+            schedule(server, 'detach', commands)
         AWAY = True
-        if w.config_get_plugin("command_on_detach"):
-            w.command("", w.config_get_plugin("command_on_detach"))
+        schedule("", 'detach', [cmd for cmd in w.config_get_plugin(
+            "command_on_detach").split(";") if cmd])
 
-    return w.WEECHAT_RC_OK
+    publish_presence(away)
 
 
 if w.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE,
-                    SCRIPT_DESC, "", ""):
+                    SCRIPT_DESC, "screen_away_unload_cb", ""):
     version = w.info_get('version_number', '') or 0
-    for option, default_desc in settings.iteritems():
+    # screen_away_mosh.py had ignore_relays, the inverse of check_relay
+    if w.config_is_set_plugin('ignore_relays'):
+        ignore_relays = w.config_string_to_boolean(
+            w.config_get_plugin('ignore_relays'))
+        if not w.config_is_set_plugin('check_relay'):
+            w.config_set_plugin('check_relay',
+                                'no' if ignore_relays else 'yes')
+        w.config_unset_plugin('ignore_relays')
+    for option, default_desc in settings.items():
         if not w.config_is_set_plugin(option):
             w.config_set_plugin(option, default_desc[0])
         if int(version) >= 0x00030500:
             w.config_set_desc_plugin(option, default_desc[1])
 
-    if 'STY' in os.environ.keys():
-        # We are running under screen
-        cmd_output = os.popen('env LC_ALL=C screen -ls').read()
-        match = re.search(r'Sockets? in (/.+)\.', cmd_output)
-        if match:
-            SOCK = os.path.join(match.group(1), os.environ['STY'])
-
-    if not SOCK and 'TMUX' in os.environ.keys():
-        # We are running under tmux
-        socket_data = os.environ['TMUX']
-        SOCK = socket_data.rsplit(',', 2)[0]
+    load_tick_budget()
+    load_pace()
+    load_delays()
+    w.hook_command(SCRIPT_NAME, 'Show how long screen_away takes',
+                   'stats || stats reset',
+                   'stats: show durations of callbacks and phases\n'
+                   'reset: forget them', 'stats reset', 'screen_away_cmd', '')
 
-    if SOCK:
-        set_timer()
-        w.hook_config("plugins.var.python." + SCRIPT_NAME + ".*",
-            "screen_away_config_cb", "")
+    name, sock = find_socket()
+    if sock:
+        start(name, sock)
+    elif name == 'screen':
+        # not in the usual places, ask screen without blocking the startup
+        w.hook_process('env LC_ALL=C screen -ls', SCREEN_LS_TIMEOUT,
+                       "screen_ls_cb", '')
@@ -22,7 +22,17 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 Description
 ------------
-This plugin is for using sendmail to send notifications
+This plugin is for using sendmail, or an SMTP server, to send notifications
+
+
+Commands
+------------
+    /sendmail_notify stats [reset]
+
+        Show or reset counters of seen, filtered, queued, sent and failed
+        notifications and latencies of the print hook and of deliveries.
+        Other scripts can read them through the sendmail_notify_stats
+        info and infolist.
 
 
 Options
@@ -42,17 +52,199 @@ Options
 
         The email addres the message will be sent to.
         Default: ''
+
+    plugins.var.python.sendmail_notify.only_when_away
+
+        Only notify while away. When screen_away runs, away is what it
+        publishes through its screen_away_presence signal, otherwise the
+        away status of the server of the line.
+        Default: on
+
+    plugins.var.python.sendmail_notify.max_concurrent
+
+        How many sendmail processes may run at the same time, at least 1.
+        Only used by the sendmail transport.
+        Default: 2
+
+    plugins.var.python.sendmail_notify.queue_size
+
+        How many notifications may wait for delivery. Once the queue is
+        full the overflow policy decides which notification is dropped.
+        Default: 100
+
+    plugins.var.python.sendmail_notify.overflow
+
+        What to drop when the queue is full: drop_oldest or drop_newest.
+        A full queue first sheds the oldest notifications of less
+        important classes, see priority_weights; overflow only decides
+        within the class of the new notification.
+        Default: drop_oldest
+
+    plugins.var.python.sendmail_notify.priority_weights
+
+        Notifications are queued in three classes, most important first:
+        private (private messages), watched (lines with watchlist
+        keywords) and highlight (everything else, digests included).
+        When deliveries have to wait, the classes take turns in
+        proportion to these class:weight pairs.
+        Default: private:4,watched:2,highlight:1
+
+    plugins.var.python.sendmail_notify.priority_caps
+
+        class:count pairs, how many notifications of a class may wait at
+        most, the oldest ones being dropped beyond that. Classes not
+        listed, or listed with 0, are only limited by queue_size.
+        Default: highlight:50
+
+    plugins.var.python.sendmail_notify.timeout
+
+        Seconds a delivery may take before it is killed and reported as
+        failed, at least 1.
+        Default: 30
+
+    plugins.var.python.sendmail_notify.transport
+
+        How notifications are delivered: sendmail runs sendmail_location
+        once per notification, smtp keeps a connection to smtp_host open
+        in a helper process and reuses it.
+        Default: sendmail
+
+    plugins.var.python.sendmail_notify.smtp_host
+
+        The SMTP server used by the smtp transport.
+        Default: localhost
+
+    plugins.var.python.sendmail_notify.smtp_port
+
+        The port of smtp_host.
+        Default: 25
+
+    plugins.var.python.sendmail_notify.smtp_batch
+
+        How many notifications may be handed to the smtp connection at a
+        time, at least 1, the others wait in the queue.
+        Default: 10
+
+    plugins.var.python.sendmail_notify.smtp_idle_timeout
+
+        Seconds an unused smtp connection is kept open, at least 1.
+        Default: 60
+
+    plugins.var.python.sendmail_notify.spool
+
+        Keep queued notifications in sendmail_notify.spool in the WeeChat
+        directory until they are delivered, so they survive a failing MTA
+        or a restart of WeeChat.
+        Default: on
+
+    plugins.var.python.sendmail_notify.spool_flush_interval
+
+        Seconds spool writes are collected before they are written and
+        synced to disk together, above 0, fractions like 0.5 allowed.
+        Default: 1
+
+    plugins.var.python.sendmail_notify.retry_schedule
+
+        Comma-separated seconds to wait before each retry of a failed
+        delivery. A notification is given up once every retry failed.
+        Default: 30,60,300,900,3600
+
+    plugins.var.python.sendmail_notify.dedup_ttl
+
+        Seconds a ping is remembered, the same message from the same nick
+        in the same buffer, ignoring case and whitespace, is not sent
+        again within that time. 0 turns this off.
+        Default: 300
+
+    plugins.var.python.sendmail_notify.dedup_size
+
+        How many pings and senders are remembered at most for dedup_ttl
+        and sender_rate.
+        Default: 1000
+
+    plugins.var.python.sendmail_notify.sender_rate
+
+        How many notifications one nick may cause, as count/seconds.
+        Empty turns the limit off.
+        Default: 5/60
+
+    plugins.var.python.sendmail_notify.global_rate
+
+        How many notifications may be sent at all, as count/seconds.
+        Empty turns the limit off.
+        Default: 30/60
+
+    plugins.var.python.sendmail_notify.watchlist
+
+        Comma-separated keywords that notify like a highlight when they
+        appear in any channel, whether or not WeeChat highlights them.
+        Keywords match whole words, case-insensitively; entries starting
+        with re: are regexes. Keywords cost the same per line however
+        many there are, each regex adds its own cost.
+        Default: ''
+
+    plugins.var.python.sendmail_notify.rule.<name>
+
+        Routing rules for pings, tried in the order of their names. A rule
+        is a list of key=value pairs, values with spaces are quoted.
+        These keys decide which pings a rule applies to, a rule applies
+        when all its keys match:
+            server, channel, nick, type (channel or private): exact
+            names, several separated by commas
+            message: regex searched in the message
+        and these what happens to them:
+            to: recipient instead of the to option
+            subject: subject template, {server}, {channel}, {nick}, {type}
+            and {message} are replaced
+            transport: transport instead of the transport option
+            mute: don't send anything
+        Example:
+            /set plugins.var.python.sendmail_notify.rule.10_work
+                "server=worknet to=me@work.example"
+            /set plugins.var.python.sendmail_notify.rule.20_boss
+                "type=private nick=boss to=pager@example.com"
+            /set plugins.var.python.sendmail_notify.rule.30_noise
+                "channel=#offtopic,#random mute"
+
+    plugins.var.python.sendmail_notify.digest
+
+        Collect pings and send them as one email per digest_window
+        instead of one email per ping.
+        Default: off
+
+    plugins.var.python.sendmail_notify.digest_window
+
+        Seconds pings are collected before the digest is sent, at least 1.
+        Default: 60
+
+    plugins.var.python.sendmail_notify.digest_max
+
+        Send the digest early once it holds this many pings.
+        Default: 20
+
+    plugins.var.python.sendmail_notify.digest_private_immediate
+
+        Send private messages right away even when digest is on.
+        Default: on
 """
 
 import weechat
+import itertools
+import json
+import os
+import re
+import shlex
+import smtplib
+import socket
+import time
+from collections import deque, OrderedDict
 from email.mime.text import MIMEText
-from subprocess import Popen, PIPE
 
 # register script
 weechat.register('sendmail_notify', 'Trey Morris', '1.0',
                  'GPL3',
                  'sendmail_notify: send notifications using sendmail',
-                 '', '')
+                 'shutdown_cb', '')
 
 # config setup
 config = {
@@ -62,9 +254,33 @@ config = {
     'debug': 'off',
     'only_when_away': 'on',
     'enabled': 'on',
+    'max_concurrent': '2',
+    'queue_size': '100',
+    'overflow': 'drop_oldest',
+    'priority_weights': 'private:4,watched:2,highlight:1',
+    'priority_caps': 'highlight:50',
+    'timeout': '30',
+    'digest': 'off',
+    'digest_window': '60',
+    'digest_max': '20',
+    'digest_private_immediate': 'on',
+    'transport': 'sendmail',
+    'smtp_host': 'localhost',
+    'smtp_port': '25',
+    'smtp_batch': '10',
+    'smtp_idle_timeout': '60',
+    'spool': 'on',
+    'spool_flush_interval': '1',
+    'retry_schedule': '30,60,300,900,3600',
+    'dedup_ttl': '300',
+    'dedup_size': '1000',
+    'sender_rate': '5/60',
+    'global_rate': '30/60',
+    'watchlist': '',
 }
+DEFAULTS = dict(config)
 
-for option, default_value in config.iteritems():
+for option, default_value in config.items():
     config_value = weechat.config_get_plugin(option)
     if config_value:
         # value is set in weechat config, store it here
@@ -73,15 +289,44 @@ for option, default_value in config.iteritems():
         # value isn't set in weechat config, set config value from defaults
         weechat.config_set_plugin(option, default_value)
 
-    # warn if value isn't valid
-    if not config[option]:
+    # warn if a required value isn't set
+    if option in ('to', 'from') and not config[option]:
         weechat.prnt('', 'sendmail_notify:i please set option |%s|' % option)
 
 
 # setup hooks
-weechat.hook_print('', '', '', 1, 'send_message', '')
+# only lines that can notify reach send_message, WeeChat filters the rest.
+# highlights in channels are plain notify_message lines, so that tag is
+# needed as well as notify_highlight
+weechat.hook_print('', 'notify_message,notify_private,notify_highlight', '',
+                   1, 'send_message', '')
 weechat.hook_config('plugins.var.python.sendmail_notify.*',
                     'update_config', '')
+for buffer_signal in ('buffer_localvar_added', 'buffer_localvar_changed',
+                      'buffer_localvar_removed', 'buffer_closed'):
+    weechat.hook_signal(buffer_signal, 'buffer_changed_cb', '')
+weechat.hook_signal('screen_away_presence', 'presence_cb', '')
+weechat.hook_command('sendmail_notify', 'sendmail_notify statistics',
+                     'stats || stats reset',
+                     'stats: show counters and latencies\n'
+                     'reset: set them back to zero',
+                     'stats reset', 'sendmail_notify_cmd', '')
+weechat.hook_info('sendmail_notify_stats',
+                  'sendmail_notify counters, as name=value pairs',
+                  'counter name (optional)', 'stats_info_cb', '')
+weechat.hook_infolist('sendmail_notify_stats',
+                      'sendmail_notify counters and latencies', '',
+                      'counter name (optional)', 'stats_infolist_cb', '')
+
+
+# delivery queues: send_message only appends to the queue of the priority
+# class of a notification, drain_queue hands queued notifications to the
+# transport from a timer so the print hook never waits on the MTA. CREDITS
+# are the weighted round robin state of drain_queue.
+PRIORITIES = ('private', 'watched', 'highlight')
+QUEUES = OrderedDict((priority, deque()) for priority in PRIORITIES)
+CREDITS = dict.fromkeys(PRIORITIES, 0)
+DRAIN_HOOK = None
 
 
 def debug_msg(msg):
@@ -89,6 +334,852 @@ def debug_msg(msg):
         weechat.prnt('', 'sendmail_notify: ' + msg)
 
 
+def error_msg(msg):
+    weechat.prnt('', '%ssendmail_notify: %s' % (weechat.prefix('error'), msg))
+
+
+# statistics, read with /sendmail_notify stats or the sendmail_notify_stats
+# info and infolist
+STAT_NAMES = ('lines_seen', 'filtered_disabled', 'filtered_not_displayed',
+              'filtered_not_away', 'filtered_not_ping', 'filtered_muted',
+              'watched', 'digested', 'queued',
+              'sent', 'failed', 'retried', 'dropped',
+              'suppressed_duplicate', 'suppressed_rate')
+STATS = dict.fromkeys(STAT_NAMES, 0)
+clock = getattr(time, 'monotonic', time.time)
+
+
+class Histogram(object):
+    """Latencies counted in buckets of powers of two microseconds, so
+       adding one is an increment of buckets[int(us).bit_length()]
+    """
+
+    def __init__(self):
+        self.buckets = [0] * 64
+
+    def reset(self):
+        self.buckets[:] = [0] * 64
+
+    def add(self, seconds):
+        self.buckets[int(seconds * 1000000).bit_length()] += 1
+
+    def count(self):
+        return sum(self.buckets)
+
+    def percentile(self, fraction):
+        """Returns the upper bound in microseconds of the bucket holding
+           the given fraction of all latencies
+        """
+        total = fraction * self.count()
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= total:
+                return 1 << bucket
+        return 0
+
+
+HISTOGRAMS = OrderedDict([
+    ('callback_time', Histogram()),
+    ('delivery_time', Histogram()),
+])
+CALLBACK_BUCKETS = HISTOGRAMS['callback_time'].buckets
+
+
+def get_stats():
+    """Returns the counters, lines_seen is taken from the callback_time
+       histogram instead of being counted separately
+    """
+    stats = dict(STATS, lines_seen=HISTOGRAMS['callback_time'].count())
+    return [(name, stats[name]) for name in STAT_NAMES]
+
+
+def stats_lines():
+    lines = ['%s: %d' % stat for stat in get_stats()]
+    lines.append('queue length: %d (%s), digest: %d, spool: %d, '
+                 'retries: %d' % (queue_length(), ', '.join(
+                     '%s %d' % (priority, len(queue))
+                     for priority, queue in QUEUES.items()),
+                     DIGEST_COUNT, SPOOL.pending, len(RETRIES)))
+    for name, histogram in HISTOGRAMS.items():
+        lines.append('%s: count %d, p50 <%dus, p99 <%dus, max <%dus' %
+                     (name, histogram.count(), histogram.percentile(0.5),
+                      histogram.percentile(0.99), histogram.percentile(1)))
+    return lines
+
+
+def sendmail_notify_cmd(data, buffer, args):
+    """Callback for /sendmail_notify"""
+    args = args.split()
+    if args == ['stats']:
+        for line in stats_lines():
+            weechat.prnt(buffer, 'sendmail_notify: ' + line)
+    elif args == ['stats', 'reset']:
+        STATS.update(dict.fromkeys(STAT_NAMES, 0))
+        for histogram in HISTOGRAMS.values():
+            histogram.reset()
+    else:
+        return weechat.WEECHAT_RC_ERROR
+    return weechat.WEECHAT_RC_OK
+
+
+def stats_info_cb(data, info_name, arguments):
+    stats = get_stats()
+    if arguments:
+        return str(dict(stats).get(arguments, ''))
+    return ','.join('%s=%d' % stat for stat in stats)
+
+
+def stats_infolist_cb(data, infolist_name, pointer, arguments):
+    """Returns one item per counter (name, value) and one per histogram
+       (name, count and p50, p99 and max bucket bounds in microseconds)
+    """
+    infolist = weechat.infolist_new()
+    for name, value in get_stats():
+        if arguments and arguments != name:
+            continue
+        item = weechat.infolist_new_item(infolist)
+        weechat.infolist_new_var_string(item, 'name', name)
+        weechat.infolist_new_var_integer(item, 'value', value)
+    for name, histogram in HISTOGRAMS.items():
+        if arguments and arguments != name:
+            continue
+        item = weechat.infolist_new_item(infolist)
+        weechat.infolist_new_var_string(item, 'name', name)
+        weechat.infolist_new_var_integer(item, 'count', histogram.count())
+        weechat.infolist_new_var_integer(item, 'p50',
+                                         histogram.percentile(0.5))
+        weechat.infolist_new_var_integer(item, 'p99',
+                                         histogram.percentile(0.99))
+        weechat.infolist_new_var_integer(item, 'max',
+                                         histogram.percentile(1))
+    return infolist
+
+
+class Notification(object):
+    """A pending email. The MIME message is only built when the
+       notification is handed to a transport, not in the print hook.
+       to and transport are set by routing rules, None means the to and
+       transport options. priority is one of PRIORITIES.
+    """
+    __slots__ = ('subject', 'body', 'queued', 'to', 'transport', 'priority',
+                 'attempts', 'spool_id')
+
+    def __init__(self, subject, body, queued=None, to=None, transport=None,
+                 priority='highlight'):
+        self.subject = subject
+        self.body = body
+        self.queued = queued or time.time()
+        self.to = to
+        self.transport = transport
+        self.priority = priority
+        self.attempts = 0
+        self.spool_id = None
+
+    def recipient(self):
+        return self.to or config['to']
+
+    def as_string(self):
+        msg = MIMEText(self.body)
+        msg['From'] = config['from']
+        msg['To'] = self.recipient()
+        msg['Subject'] = self.subject
+        return msg.as_string()
+
+
+def parse_priorities(value):
+    """Parses class:number pairs into a dict, raises ValueError if a
+       class is unknown or a number doesn't parse
+    """
+    numbers = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        priority, _, number = item.partition(':')
+        priority = priority.strip()
+        if priority not in QUEUES:
+            raise ValueError('unknown class |%s|' % priority)
+        numbers[priority] = int(number)
+    return numbers
+
+
+def parse_weights(value):
+    """Parses priority_weights, classes not listed get a weight of 1"""
+    weights = parse_priorities(value)
+    return dict((priority, max(weights.get(priority, 1), 1))
+                for priority in PRIORITIES)
+
+
+def queue_length():
+    return sum(len(queue) for queue in QUEUES.values())
+
+
+def enqueue(notification):
+    """Queue a notification for delivery. If its class is at its cap the
+       overflow policy drops one of that class, if the whole queue is full
+       the oldest notification of the least important class that holds
+       any is shed, down to the class of the new one.
+    """
+    if not notification.attempts:
+        STATS['queued'] += 1
+    if config['spool'] == 'on' and notification.spool_id is None:
+        SPOOL.add(notification)
+    queue = QUEUES[notification.priority]
+    cap = PARSED['priority_caps'].get(notification.priority)
+    victim = None
+    if cap and len(queue) >= cap:
+        victim = notification.priority
+    elif queue_length() >= PARSED['queue_size']:
+        for victim in reversed(PRIORITIES):
+            if victim == notification.priority or QUEUES[victim]:
+                break
+    if victim is not None:
+        if victim == notification.priority and (
+                config['overflow'] == 'drop_newest' or not queue):
+            delivery_done(notification, 'queue full, dropped', retry=False)
+            return
+        delivery_done(QUEUES[victim].popleft(), 'queue full, dropped',
+                      retry=False)
+    queue.append(notification)
+    schedule_drain()
+
+
+def schedule_drain():
+    global DRAIN_HOOK
+    if DRAIN_HOOK is None:
+        DRAIN_HOOK = weechat.hook_timer(1, 0, 1, 'drain_queue', '')
+
+
+def next_priority(weights):
+    """Smooth weighted round robin: returns the class that goes next, the
+       one with queued notifications holding the most credits once each
+       got its weight added
+    """
+    best = best_credits = None
+    for priority, queue in QUEUES.items():
+        if not queue:
+            CREDITS[priority] = 0
+            continue
+        credits = CREDITS[priority] + weights[priority]
+        if best is None or credits > best_credits:
+            best, best_credits = priority, credits
+    return best
+
+
+def charge(best, weights):
+    """Every class with queued notifications gets its weight in credits,
+       the class that went pays them all
+    """
+    for priority, queue in QUEUES.items():
+        if queue:
+            CREDITS[priority] += weights[priority]
+            CREDITS[best] -= weights[priority]
+
+
+def drain_queue(data, remaining_calls):
+    """Timer callback, hands queued notifications to their transport as
+       long as it has capacity for them, taking them from the classes in
+       proportion to priority_weights. Consecutive notifications for the
+       same transport are handed over as one batch.
+    """
+    global DRAIN_HOOK
+    DRAIN_HOOK = None
+    weights = PARSED['priority_weights']
+    batch = []
+    transport = None
+    while True:
+        priority = next_priority(weights)
+        if priority is None:
+            break
+        name = QUEUES[priority][0].transport
+        if batch and (name != batch[0].transport or
+                      len(batch) >= transport.batch_size()):
+            transport.deliver(batch)
+            batch = []
+        if not batch:
+            transport = get_transport(name)
+            if not transport.has_capacity():
+                break
+        charge(priority, weights)
+        batch.append(QUEUES[priority].popleft())
+    if batch:
+        transport.deliver(batch)
+    return weechat.WEECHAT_RC_OK
+
+
+def get_transport(name=None):
+    name = name or config['transport']
+    transport = TRANSPORTS.get(name)
+    if transport is None:
+        error_msg('unknown transport |%s|, using sendmail' % name)
+        transport = TRANSPORTS['sendmail']
+    return transport
+
+
+class SendmailTransport(object):
+    """Pipes every notification into its own sendmail process started with
+       hook_process, so delivery never blocks WeeChat
+    """
+
+    def __init__(self):
+        self.deliveries = {}
+        self.ids = itertools.count()
+
+    def has_capacity(self):
+        return len(self.deliveries) < PARSED['max_concurrent']
+
+    def batch_size(self):
+        return 1
+
+    def deliver(self, notifications):
+        for notification in notifications:
+            delivery_id = str(next(self.ids))
+            hook = weechat.hook_process_hashtable(
+                config['sendmail_location'], {'arg1': '-t', 'stdin': '1'},
+                PARSED['timeout'] * 1000, 'sendmail_cb', delivery_id)
+            if not hook:
+                delivery_done(notification, 'unable to start sendmail')
+                continue
+            self.deliveries[delivery_id] = notification
+            weechat.hook_set(hook, 'stdin', notification.as_string())
+            weechat.hook_set(hook, 'stdin_close', '')
+
+    def process_done(self, delivery_id, return_code, err):
+        notification = self.deliveries.pop(delivery_id, None)
+        if notification is None:
+            return
+        if return_code == 0:
+            delivery_done(notification)
+        elif return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
+            delivery_done(notification, 'sendmail failed or timed out')
+        else:
+            delivery_done(notification, 'sendmail exited with %s: %s' %
+                          (return_code, err.strip()))
+
+    def close(self):
+        pass
+
+
+class SmtpTransport(object):
+    """Sends notifications over one SMTP connection kept open by a helper
+       process, smtp_helper started with hook_process, so WeeChat never
+       waits on the SMTP server. Notifications are written to the stdin of
+       the helper and it reports every delivery on its stdout. At most
+       smtp_batch notifications are handed to it at a time, the rest wait
+       in the queue. The helper exits once it has been idle for
+       smtp_idle_timeout seconds.
+    """
+
+    def __init__(self):
+        self.hook = None
+        self.helper = None
+        self.helper_ids = itertools.count()
+        self.ids = itertools.count()
+        # delivery id: (helper id, notification), helper id: partial line
+        self.deliveries = {}
+        self.output = {}
+        self.idle_hook = None
+
+    def has_capacity(self):
+        return len(self.deliveries) < PARSED['smtp_batch']
+
+    def batch_size(self):
+        return PARSED['smtp_batch'] - len(self.deliveries)
+
+    def start(self):
+        self.helper = str(next(self.helper_ids))
+        self.hook = weechat.hook_process_hashtable(
+            'func:smtp_helper', {'stdin': '1', 'buffer_flush': '1'}, 0,
+            'smtp_cb', self.helper)
+        if not self.hook:
+            self.hook = self.helper = None
+            return False
+        self.output[self.helper] = ''
+        return True
+
+    def deliver(self, notifications):
+        if self.hook is None and not self.start():
+            for notification in notifications:
+                delivery_done(notification, 'unable to start smtp helper')
+            return
+        for notification in notifications:
+            delivery_id = next(self.ids)
+            self.deliveries[delivery_id] = (self.helper, notification)
+            recipients = [to.strip() for to in
+                          notification.recipient().split(',')]
+            weechat.hook_set(self.hook, 'stdin', json.dumps(
+                [delivery_id, config['smtp_host'], PARSED['smtp_port'],
+                 PARSED['timeout'], config['from'], recipients,
+                 notification.as_string()]) + '\n')
+        self.reset_idle_timer()
+
+    def process_output(self, helper, return_code, out, err):
+        """Completes the deliveries a helper reported, and fails the ones
+           it didn't once it exited
+        """
+        lines = (self.output.pop(helper, '') + out).split('\n')
+        if return_code == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+            self.output[helper] = lines.pop()
+        for line in lines:
+            try:
+                delivery_id, error = json.loads(line)
+            except ValueError:
+                continue
+            _, notification = self.deliveries.pop(delivery_id, (None, None))
+            if notification is not None:
+                delivery_done(notification, native_str(error))
+        if helper == self.helper:
+            self.reset_idle_timer()
+        if return_code == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+            return
+        if helper == self.helper:
+            self.hook = self.helper = None
+        error = err.strip() or 'smtp helper exited with %s' % return_code
+        for delivery_id, (owner, notification) in \
+                list(self.deliveries.items()):
+            if owner == helper:
+                del self.deliveries[delivery_id]
+                delivery_done(notification, error)
+
+    def reset_idle_timer(self):
+        if self.idle_hook is not None:
+            weechat.unhook(self.idle_hook)
+        self.idle_hook = weechat.hook_timer(
+            PARSED['smtp_idle_timeout'] * 1000, 0, 1, 'smtp_idle_cb', '')
+
+    def close(self):
+        """Closes the stdin of the helper, it exits once it has sent what
+           it was given
+        """
+        if self.idle_hook is not None:
+            weechat.unhook(self.idle_hook)
+            self.idle_hook = None
+        if self.hook is None:
+            return
+        weechat.hook_set(self.hook, 'stdin_close', '')
+        self.hook = self.helper = None
+
+
+def smtp_helper(data):
+    """Runs in the process started by SmtpTransport, never calls the
+       WeeChat API. Reads one delivery per line from stdin, sends it over
+       a connection that is kept open and writes [delivery id, error or
+       null] to stdout. A connection the server dropped is reopened once.
+    """
+    conn = server = None
+    stdin = os.fdopen(0)
+    for line in iter(stdin.readline, ''):
+        try:
+            (delivery_id, host, port, timeout, sender, recipients,
+             message) = json.loads(line)
+        except ValueError:
+            continue
+        error = None
+        fresh = False
+        while True:
+            try:
+                if conn is None or server != (host, port):
+                    smtp_quit(conn)
+                    conn, server, fresh = None, (host, port), True
+                    conn = smtplib.SMTP(host, port, timeout=timeout)
+                conn.sendmail(sender, recipients, native_str(message))
+                break
+            except smtplib.SMTPServerDisconnected as e:
+                dropped = e
+            except smtplib.SMTPException as e:
+                # SMTPException is a socket.error on python 3
+                error = str(e)
+                break
+            except socket.error as e:
+                dropped = e
+            # a reused connection may have been closed by the server,
+            # reconnect once before giving up
+            smtp_quit(conn)
+            conn = None
+            if fresh:
+                error = 'unable to send over %s:%s: %s' % (host, port,
+                                                           dropped)
+                break
+        os.write(1, (json.dumps([delivery_id, error]) + '\n').encode())
+    smtp_quit(conn)
+    return ''
+
+
+def smtp_quit(conn):
+    if conn is None:
+        return
+    try:
+        conn.quit()
+    except (smtplib.SMTPException, socket.error):
+        pass
+
+
+TRANSPORTS = {
+    'sendmail': SendmailTransport(),
+    'smtp': SmtpTransport(),
+}
+
+
+def sendmail_cb(data, command, return_code, out, err):
+    """Callback called by hook_process when sendmail exits"""
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+        return weechat.WEECHAT_RC_OK
+    TRANSPORTS['sendmail'].process_done(data, return_code, err)
+    if queue_length():
+        schedule_drain()
+    return weechat.WEECHAT_RC_OK
+
+
+def smtp_cb(data, command, return_code, out, err):
+    """Callback called by hook_process with what the smtp helper reports"""
+    TRANSPORTS['smtp'].process_output(data, return_code, out, err)
+    if queue_length():
+        schedule_drain()
+    return weechat.WEECHAT_RC_OK
+
+
+def smtp_idle_cb(data, remaining_calls):
+    """Timer callback, stops the smtp helper once it has been idle"""
+    smtp = TRANSPORTS['smtp']
+    smtp.idle_hook = None
+    smtp.close()
+    debug_msg('closed idle smtp connection')
+    return weechat.WEECHAT_RC_OK
+
+
+def delivery_done(notification, error=None, retry=True):
+    """Completion callback for every notification leaving the queue,
+       reports failures in the core buffer and schedules retries
+    """
+    if error:
+        delay = next_retry(notification) if retry else None
+        if delay is not None:
+            STATS['retried'] += 1
+            error_msg('unable to send |%s|: %s, retrying in %ds' %
+                      (notification.subject, error, delay))
+            retry_id = str(next(RETRY_IDS))
+            RETRIES[retry_id] = notification
+            weechat.hook_timer(delay * 1000, 0, 1, 'retry_cb', retry_id)
+            return
+        STATS['failed' if retry else 'dropped'] += 1
+        error_msg('unable to send |%s|: %s' % (notification.subject, error))
+    else:
+        STATS['sent'] += 1
+        HISTOGRAMS['delivery_time'].add(time.time() - notification.queued)
+        debug_msg('sent |%s|%s|%s|%s|' % (config['from'],
+                                          notification.recipient(),
+                                          notification.subject,
+                                          notification.body))
+    SPOOL.remove(notification)
+
+
+# notifications waiting for their next delivery attempt
+RETRIES = {}
+RETRY_IDS = itertools.count()
+
+
+def next_retry(notification):
+    """Returns the seconds to wait before retrying a failed notification,
+       None once retry_schedule is used up
+    """
+    try:
+        schedule = [int(delay) for delay in
+                    config['retry_schedule'].split(',') if delay.strip()]
+    except ValueError:
+        error_msg('invalid retry_schedule |%s|' % config['retry_schedule'])
+        return None
+    if notification.attempts >= len(schedule):
+        return None
+    notification.attempts += 1
+    return schedule[notification.attempts - 1]
+
+
+def retry_cb(data, remaining_calls):
+    notification = RETRIES.pop(data, None)
+    if notification is not None:
+        enqueue(notification)
+    return weechat.WEECHAT_RC_OK
+
+
+class Spool(object):
+    """Append-only journal of undelivered notifications.
+
+       Every queued notification is written as a line
+       '+<id> [subject, body, queued, to, transport, priority]' and a line
+       '-<id>' is written once it was delivered or given up. Lines are
+       buffered and written and synced together by spool_flush_cb. The
+       journal is truncated whenever nothing is pending and compacted when
+       it is loaded.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.writes = []
+        self.pending = 0
+        self.flush_hook = None
+        self.ids = itertools.count()
+
+    def get_path(self):
+        if self.path is None:
+            weechat_dir = (weechat.info_get('weechat_data_dir', '') or
+                           weechat.info_get('weechat_dir', ''))
+            self.path = os.path.join(weechat_dir, 'sendmail_notify.spool')
+        return self.path
+
+    def record(self, notification):
+        notification.spool_id = next(self.ids)
+        return '+%d %s\n' % (notification.spool_id, json.dumps(
+            [notification.subject, notification.body, notification.queued,
+             notification.to, notification.transport,
+             notification.priority]))
+
+    def add(self, notification):
+        self.pending += 1
+        self.write(self.record(notification))
+
+    def remove(self, notification):
+        if notification.spool_id is None:
+            return
+        self.pending -= 1
+        self.write('-%d\n' % notification.spool_id)
+        notification.spool_id = None
+
+    def write(self, line):
+        self.writes.append(line)
+        if self.flush_hook is None:
+            self.flush_hook = weechat.hook_timer(
+                max(int(PARSED['spool_flush_interval'] * 1000), 1), 0, 1,
+                'spool_flush_cb', '')
+
+    def flush(self):
+        if self.flush_hook is not None:
+            weechat.unhook(self.flush_hook)
+            self.flush_hook = None
+        if not self.writes:
+            return
+        if self.pending:
+            mode, data = 'a', ''.join(self.writes)
+        else:
+            # nothing is pending, the whole journal can go
+            mode, data = 'w', ''
+        del self.writes[:]
+        try:
+            with open(self.get_path(), mode) as spool:
+                spool.write(data)
+                spool.flush()
+                os.fsync(spool.fileno())
+        except (IOError, OSError) as e:
+            error_msg('unable to write spool: %s' % e)
+
+    def load(self):
+        """Returns the notifications left in the journal and rewrites it
+           holding only those
+        """
+        records = OrderedDict()
+        try:
+            with open(self.get_path()) as spool:
+                for line in spool:
+                    if line.startswith('-'):
+                        records.pop(line[1:].strip(), None)
+                        continue
+                    try:
+                        spool_id, record = line[1:].split(' ', 1)
+                        records[spool_id] = json.loads(record)
+                    except ValueError:
+                        # torn write from a crash, skip it
+                        continue
+        except (IOError, OSError):
+            return []
+
+        notifications = []
+        lines = []
+        for record in records.values():
+            # journals written before priorities hold five fields
+            subject, body, queued, to, transport = record[:5]
+            priority = record[5] if len(record) > 5 else 'highlight'
+            if priority not in QUEUES:
+                priority = 'highlight'
+            notification = Notification(native_str(subject), native_str(body),
+                                        queued, native_str(to),
+                                        native_str(transport),
+                                        native_str(priority))
+            lines.append(self.record(notification))
+            notifications.append(notification)
+        self.pending = len(notifications)
+
+        # rewrite the journal holding only what is still pending
+        try:
+            path = self.get_path()
+            with open(path + '.tmp', 'w') as spool:
+                spool.write(''.join(lines))
+                spool.flush()
+                os.fsync(spool.fileno())
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            error_msg('unable to compact spool: %s' % e)
+        return notifications
+
+
+SPOOL = Spool()
+
+
+def native_str(value):
+    """json gives back unicode on python 2, the rest of the script uses
+       utf-8 encoded str
+    """
+    if value is not None and not isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def spool_flush_cb(data, remaining_calls):
+    SPOOL.flush_hook = None
+    SPOOL.flush()
+    return weechat.WEECHAT_RC_OK
+
+
+# notifications loaded from the spool, fed into the queue by replay_cb as
+# the queue has room for them
+REPLAY = deque()
+
+
+def replay_cb(data, remaining_calls):
+    """Timer callback, moves replayed notifications into the queue a few
+       at a time so a large spool doesn't block WeeChat. A notification
+       only goes in once its class is below its priority_caps and the
+       queue below queue_size, so none is shed, the others wait.
+    """
+    waiting = deque()
+    while REPLAY and queue_length() < PARSED['queue_size']:
+        notification = REPLAY.popleft()
+        cap = PARSED['priority_caps'].get(notification.priority)
+        if cap and len(QUEUES[notification.priority]) >= cap:
+            waiting.append(notification)
+        else:
+            enqueue(notification)
+    REPLAY.extendleft(reversed(waiting))
+    if REPLAY:
+        weechat.hook_timer(1000, 0, 1, 'replay_cb', '')
+    return weechat.WEECHAT_RC_OK
+
+
+def shutdown_cb():
+    """Called when the script is unloaded, makes sure collected pings and
+       buffered spool writes reach the disk
+    """
+    flush_digest()
+    SPOOL.flush()
+    return weechat.WEECHAT_RC_OK
+
+
+# digest: pings grouped by (to, transport, server, channel) until
+# digest_flush_cb fires or digest_max pings have been collected
+DIGEST = OrderedDict()
+DIGEST_COUNT = 0
+DIGEST_HOOK = None
+
+
+def add_to_digest(server, channel, line, to=None, transport=None):
+    """Collect a ping for the next digest, starting the flush timer with
+       the first ping of a window
+    """
+    global DIGEST_COUNT, DIGEST_HOOK
+    STATS['digested'] += 1
+    DIGEST.setdefault((to, transport, server, channel), []).append(line)
+    DIGEST_COUNT += 1
+    if DIGEST_COUNT >= PARSED['digest_max']:
+        flush_digest()
+    elif DIGEST_HOOK is None:
+        DIGEST_HOOK = weechat.hook_timer(
+            PARSED['digest_window'] * 1000, 0, 1, 'digest_flush_cb', '')
+
+
+def digest_flush_cb(data, remaining_calls):
+    global DIGEST_HOOK
+    DIGEST_HOOK = None
+    flush_digest()
+    return weechat.WEECHAT_RC_OK
+
+
+def flush_digest():
+    """Queue one email per recipient and transport holding every ping
+       collected for them, grouped by server and channel
+    """
+    global DIGEST_COUNT, DIGEST_HOOK
+    if DIGEST_HOOK is not None:
+        weechat.unhook(DIGEST_HOOK)
+        DIGEST_HOOK = None
+    if not DIGEST:
+        return
+
+    routes = OrderedDict()
+    for (to, transport, server, channel), pings in DIGEST.items():
+        routes.setdefault((to, transport), []).append(
+            (server, channel, pings))
+    DIGEST.clear()
+    DIGEST_COUNT = 0
+
+    summary = suppressed_summary()
+    for (to, transport), buffers in routes.items():
+        lines = []
+        last_server = None
+        for server, channel, pings in buffers:
+            if server != last_server:
+                lines.append(server)
+                last_server = server
+            lines.append('  %s' % channel)
+            lines.extend('    %s' % ping for ping in pings)
+        subject = '%d pings in %s' % (
+            sum(len(pings) for _, _, pings in buffers),
+            ', '.join('%s.%s' % (server, channel)
+                      for server, channel, _ in buffers))
+        enqueue(Notification(subject, '\n'.join(lines) + summary,
+                             to=to, transport=transport))
+        summary = ''
+
+
+# localvars of the buffers send_message has seen, dropped again by
+# buffer_changed_cb whenever a localvar of the buffer changes
+BUFFER_CACHE = {}
+
+
+def get_buffer_info(msg_buffer):
+    """Returns (server, channel, away message, buffer type) of a buffer"""
+    try:
+        return BUFFER_CACHE[msg_buffer]
+    except KeyError:
+        pass
+    info = BUFFER_CACHE[msg_buffer] = (
+        weechat.buffer_get_string(msg_buffer, 'localvar_server'),
+        weechat.buffer_get_string(msg_buffer, 'localvar_channel'),
+        weechat.buffer_get_string(msg_buffer, 'localvar_away'),
+        weechat.buffer_get_string(msg_buffer, 'localvar_type'))
+    return info
+
+
+def buffer_changed_cb(data, signal, signal_data):
+    """Callback called when a buffer localvar changes or a buffer is
+       closed, forgets the cached localvars of that buffer
+    """
+    BUFFER_CACHE.pop(signal_data, None)
+    return weechat.WEECHAT_RC_OK
+
+
+# True or False while screen_away publishes its presence, None otherwise
+PRESENCE_AWAY = None
+
+
+def presence_cb(data, signal, signal_data):
+    """Callback for the screen_away_presence signal, signal_data is
+       state=away|back|unknown,since=<unix time>,source=<providers>
+    """
+    global PRESENCE_AWAY
+    presence = dict(item.split('=', 1) for item in signal_data.split(',')
+                    if '=' in item)
+    PRESENCE_AWAY = {'away': True, 'back': False}.get(presence.get('state'))
+    return weechat.WEECHAT_RC_OK
+
+
 def is_ping(buffer_type, prefix, channel, highlight):
     """Determine if a message was a ping
        private type AND prefix nick is channel name = ping
@@ -102,10 +1193,298 @@ def is_ping(buffer_type, prefix, channel, highlight):
     return False
 
 
+# routing rules: the rule.* options compiled by compile_rules. RULE_INDEX
+# maps (server, channel, nick, type), with None for keys a rule doesn't
+# match on, to the rules in priority order. RULE_SHAPES holds which keys
+# are set in at least one rule, so a line costs at most one dict lookup
+# per shape however many rules there are. Message regexes are compiled
+# once per rule and only searched for the rules a line is a candidate for.
+RULE_OPTIONS = {}
+RULE_INDEX = {}
+RULE_SHAPES = []
+RULE_MATCH_KEYS = ('server', 'channel', 'nick', 'type')
+NICK_MODES = '~&@%+!'
+
+
+class Rule(object):
+    __slots__ = ('name', 'priority', 'regex', 'to', 'subject', 'transport',
+                 'mute')
+
+    def __init__(self, name, priority):
+        self.name = name
+        self.priority = priority
+        self.regex = None
+        self.to = None
+        self.subject = None
+        self.transport = None
+        self.mute = False
+
+
+def parse_rule(name, priority, value):
+    """Parses a rule option into its match keys and a Rule, raises
+       ValueError if it isn't valid
+    """
+    rule = Rule(name, priority)
+    match = {}
+    for token in shlex.split(value):
+        if token == 'mute':
+            rule.mute = True
+            continue
+        key, sep, arg = token.partition('=')
+        if not sep:
+            raise ValueError('expected key=value, got |%s|' % token)
+        if key in RULE_MATCH_KEYS:
+            match[key] = [item for item in arg.split(',') if item]
+        elif key == 'message':
+            rule.regex = re.compile(arg)
+        elif key in ('to', 'subject', 'transport'):
+            setattr(rule, key, arg)
+        else:
+            raise ValueError('unknown key |%s|' % key)
+    return match, rule
+
+
+def compile_rules():
+    """Builds RULE_INDEX and RULE_SHAPES from RULE_OPTIONS, rules are
+       tried in the order of their names
+    """
+    global RULE_SHAPES
+    index = {}
+    shapes = set()
+    for priority, name in enumerate(sorted(RULE_OPTIONS)):
+        try:
+            match, rule = parse_rule(name, priority, RULE_OPTIONS[name])
+        except (ValueError, re.error) as e:
+            error_msg('invalid rule |%s|: %s' % (name, e))
+            continue
+        keys = [()]
+        for key in RULE_MATCH_KEYS:
+            keys = [prefix + (value,) for prefix in keys
+                    for value in match.get(key, [None])]
+        for key in keys:
+            index.setdefault(key, []).append(rule)
+            shapes.add(tuple(value is not None for value in key))
+    RULE_INDEX.clear()
+    RULE_INDEX.update(index)
+    RULE_SHAPES = sorted(shapes)
+
+
+def match_rule(server, channel, nick, buffer_type, message):
+    """Returns the first rule matching a ping, None if no rule does"""
+    if not RULE_SHAPES:
+        return None
+    fields = (server, channel, nick.lstrip(NICK_MODES), buffer_type)
+    candidates = []
+    for shape in RULE_SHAPES:
+        key = tuple(field if wanted else None
+                    for field, wanted in zip(fields, shape))
+        candidates.extend(RULE_INDEX.get(key, ()))
+    if not candidates:
+        return None
+    candidates.sort(key=lambda rule: rule.priority)
+
+    for rule in candidates:
+        if rule.regex is None or rule.regex.search(message):
+            return rule
+    return None
+
+
+def load_rules():
+    """Reads the rule.* options that are already set"""
+    infolist = weechat.infolist_get(
+        'option', '', 'plugins.var.python.sendmail_notify.rule.*')
+    if infolist:
+        while weechat.infolist_next(infolist):
+            name = weechat.infolist_string(infolist, 'full_name')
+            RULE_OPTIONS[name.split('.rule.', 1)[1]] = \
+                weechat.infolist_string(infolist, 'value')
+        weechat.infolist_free(infolist)
+    compile_rules()
+
+
+# watchlist: the watchlist option compiled by compile_watchlist. Plain
+# keywords are merged into one trie shaped alternation, WATCH_REGEX, so
+# matching doesn't slow down as keywords are added. re: entries are
+# compiled on their own into WATCH_PATTERNS, as (entry, regex), so their
+# flags and backreferences keep working.
+WATCH_REGEX = None
+WATCH_WORDS = {}
+WATCH_PATTERNS = []
+
+
+def trie_pattern(node):
+    """Returns a regex matching every word of a trie made of nested dicts,
+       '' marking the end of a word
+    """
+    branches = [re.escape(char) + trie_pattern(child)
+                for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and '' not in node:
+        return branches[0]
+    pattern = '(?:%s)' % '|'.join(branches)
+    return pattern + '?' if '' in node else pattern
+
+
+def compile_watchlist():
+    global WATCH_REGEX, WATCH_PATTERNS
+    WATCH_WORDS.clear()
+    WATCH_PATTERNS = []
+    trie = {}
+    for entry in config['watchlist'].split(','):
+        entry = entry.strip()
+        if entry.startswith('re:'):
+            try:
+                WATCH_PATTERNS.append((entry, re.compile(entry[3:], re.I)))
+            except re.error as e:
+                error_msg('invalid watchlist regex |%s|: %s' % (entry[3:], e))
+        elif entry:
+            WATCH_WORDS[entry.lower()] = entry
+            node = trie
+            for char in entry.lower():
+                node = node.setdefault(char, {})
+            node[''] = True
+    WATCH_REGEX = None
+    if trie:
+        WATCH_REGEX = re.compile(r'(?<!\w)(?:%s)(?!\w)' % trie_pattern(trie),
+                                 re.I)
+
+
+def watch_hits(message):
+    """Returns the watchlist entries found in a message, in order of
+       appearance
+    """
+    found = []
+    if WATCH_REGEX is not None:
+        found.extend((match.start(), WATCH_WORDS[match.group().lower()])
+                     for match in WATCH_REGEX.finditer(message))
+    for entry, regex in WATCH_PATTERNS:
+        match = regex.search(message)
+        if match:
+            found.append((match.start(), entry))
+    found.sort(key=lambda hit: hit[0])
+    hits = []
+    for _, hit in found:
+        if hit not in hits:
+            hits.append(hit)
+    return hits
+
+
+# flood suppression: pings sent within dedup_ttl mapped to when they
+# expire, token buckets of senders and of everything, and what was
+# suppressed since the last notification went out. RECENT and SENDERS are
+# kept in least recently used order and trimmed to dedup_size.
+RECENT = OrderedDict()
+SENDERS = OrderedDict()
+GLOBAL_BUCKET = [None, 0.0]
+SUPPRESSED = OrderedDict()
+NORMALIZE_SPACE = re.compile(r'\s+')
+
+
+def normalize(message):
+    """Lowercases a message and folds whitespace, numbers are kept so
+       pings that only differ in a ticket or host name are all sent
+    """
+    return NORMALIZE_SPACE.sub(' ', message.strip().lower())
+
+
+def parse_rate(rate):
+    """Parses count/seconds into (count, seconds), None if empty, raises
+       ValueError if it isn't valid
+    """
+    if not rate.strip():
+        return None
+    count, seconds = rate.split('/')
+    count, seconds = float(count), float(seconds)
+    if count < 0 or seconds <= 0:
+        raise ValueError('expected count/seconds, seconds above 0')
+    return count, seconds
+
+
+def take_token(bucket, rate, now):
+    """Token bucket holding up to count tokens and refilling count tokens
+       per seconds. bucket is [tokens, last update], tokens None when new.
+    """
+    count, seconds = rate
+    if bucket[0] is None:
+        bucket[0] = count
+    else:
+        bucket[0] = min(count, bucket[0] + (now - bucket[1]) * count / seconds)
+    bucket[1] = now
+    if bucket[0] < 1:
+        return False
+    bucket[0] -= 1
+    return True
+
+
+def remember(cache, key, value):
+    """Stores value under key as the most recently used entry, dropping
+       the least recently used ones beyond dedup_size
+    """
+    cache.pop(key, None)
+    cache[key] = value
+    while len(cache) > PARSED['dedup_size']:
+        cache.popitem(last=False)
+
+
+def suppress(server, channel, prefix, message):
+    """Returns True if a ping should not be sent, because it repeats one
+       sent within dedup_ttl or its sender or everybody together is over
+       the rate limit. Suppressed pings are counted for
+       suppressed_summary.
+    """
+    now = time.time()
+    ttl = PARSED['dedup_ttl']
+    if ttl:
+        key = (server, channel, prefix, normalize(message))
+        if RECENT.get(key, 0) > now:
+            STATS['suppressed_duplicate'] += 1
+            count_suppressed(server, channel)
+            return True
+
+    sender_rate = PARSED['sender_rate']
+    if sender_rate:
+        bucket = SENDERS.get((server, prefix)) or [None, now]
+        remember(SENDERS, (server, prefix), bucket)
+        if not take_token(bucket, sender_rate, now):
+            STATS['suppressed_rate'] += 1
+            count_suppressed(server, channel)
+            return True
+
+    global_rate = PARSED['global_rate']
+    if global_rate and not take_token(GLOBAL_BUCKET, global_rate, now):
+        STATS['suppressed_rate'] += 1
+        count_suppressed(server, channel)
+        return True
+
+    if ttl:
+        remember(RECENT, key, now + ttl)
+    return False
+
+
+def count_suppressed(server, channel):
+    label = '%s.%s' % (server, channel)
+    SUPPRESSED[label] = SUPPRESSED.get(label, 0) + 1
+
+
+def suppressed_summary():
+    """Returns a note about suppressed pings to append to the next
+       notification, and forgets them
+    """
+    if not SUPPRESSED:
+        return ''
+    summary = '\n\n(suppressed %d repeated or flooding pings: %s)' % (
+        sum(SUPPRESSED.values()),
+        ', '.join('%d in %s' % (count, label)
+                  for label, count in SUPPRESSED.items()))
+    SUPPRESSED.clear()
+    return summary
+
+
 def send_message(data, msg_buffer, date, tags,
                  displayed, highlight, prefix, message):
     """Callback called when highlight or private message is received.
-       Creates an email and uses subprocess to call sendmail to send it.
+       Creates a notification and queues it for delivery.
 
        args:
            data: appears to always be empty
@@ -118,52 +1497,170 @@ def send_message(data, msg_buffer, date, tags,
            message: the text portion of what the sender sent
 
     """
+    start = clock()
+    notify(msg_buffer, displayed, highlight, prefix, message)
+    CALLBACK_BUCKETS[int((clock() - start) * 1000000).bit_length()] += 1
+    return weechat.WEECHAT_RC_OK
+
+
+def notify(msg_buffer, displayed, highlight, prefix, message):
+    """Filters a printed line and queues or digests a notification for
+       it if it was a ping
+    """
     # return if not enabled
     if not config['enabled'] == 'on':
-        return weechat.WEECHAT_RC_OK
+        STATS['filtered_disabled'] += 1
+        return
 
     # return if message not displayed
     if displayed == '0':
-        return weechat.WEECHAT_RC_OK
+        STATS['filtered_not_displayed'] += 1
+        return
+
+    # return if only_when_away is on and screen_away says we aren't away
+    if config['only_when_away'] == 'on' and PRESENCE_AWAY is False:
+        STATS['filtered_not_away'] += 1
+        debug_msg('not away, not sending message')
+        return
 
     # query for extra data
-    server = weechat.buffer_get_string(msg_buffer, 'localvar_server')
-    channel = weechat.buffer_get_string(msg_buffer, 'localvar_channel')
-    #nick = weechat.buffer_get_string(msg_buffer, 'localvar_nick')
-    away_msg = weechat.buffer_get_string(msg_buffer, 'localvar_away')
-    buffer_type = weechat.buffer_get_string(msg_buffer, 'localvar_type')
-
-    # return if only_when_away is on and we aren't away
-    if config['only_when_away'] == 'on':
-        if not away_msg:
-            # away message is empty, this means we are not away
-            debug_msg('not away, not sending message')
-            return weechat.WEECHAT_RC_OK
-
-    # return unless this was a ping of some sort
-    if not is_ping(buffer_type, prefix, channel, highlight):
+    server, channel, away_msg, buffer_type = get_buffer_info(msg_buffer)
+
+    # without screen_away, return if only_when_away is on and the server
+    # has no away message, meaning we are not away
+    if config['only_when_away'] == 'on' and PRESENCE_AWAY is None and \
+            not away_msg:
+        STATS['filtered_not_away'] += 1
+        debug_msg('not away, not sending message')
+        return
+
+    # return unless this was a ping of some sort or has watched keywords
+    watched = (WATCH_REGEX is not None or WATCH_PATTERNS) and \
+        watch_hits(message)
+    if watched:
+        STATS['watched'] += 1
+    elif not is_ping(buffer_type, prefix, channel, highlight):
+        STATS['filtered_not_ping'] += 1
         debug_msg('not a a ping, not sending message')
-        return weechat.WEECHAT_RC_OK
+        return
+
+    # return if a routing rule mutes this ping
+    rule = match_rule(server, channel, prefix, buffer_type, message)
+    if rule is not None and rule.mute:
+        STATS['filtered_muted'] += 1
+        debug_msg('muted by rule |%s|, not sending message' % rule.name)
+        return
+    to = rule and rule.to
+    transport = rule and rule.transport
+
+    # return if the same ping was just sent or the sender is flooding
+    if suppress(server, channel, prefix, message):
+        return
 
     # create message body/subject
     if buffer_type == 'private':
         body = '%s: %s' % (prefix, message)
         subject = 'private message from %s on %s' % (prefix, server)
-    elif buffer_type == 'channel':
+    else:
         body = '%s: %s' % (prefix, message)
         subject = 'pinged in %s.%s' % (server, channel)
+    if watched:
+        body = '%s\n\nwatched: %s' % (body, ', '.join(watched))
+        if not is_ping(buffer_type, prefix, channel, highlight):
+            subject = 'watched %s in %s.%s' % (', '.join(watched), server,
+                                               channel)
+    if rule is not None and rule.subject:
+        subject = format_subject(rule, subject, server=server,
+                                 channel=channel, nick=prefix,
+                                 type=buffer_type, message=message)
 
-    # send mail
-    msg = MIMEText(body)
-    msg['From'] = config['from']
-    msg['To'] = config['to']
-    msg['Subject'] = subject
-    p = Popen(['/usr/sbin/sendmail', '-t'], stdin=PIPE)
-    p.communicate(msg.as_string())
+    # collect the ping for the digest unless it should go out right away
+    if config['digest'] == 'on' and not (
+            buffer_type == 'private' and
+            config['digest_private_immediate'] == 'on'):
+        add_to_digest(server, channel, body, to, transport)
+        return
+
+    # queue mail, it is sent from drain_queue
+    if buffer_type == 'private':
+        priority = 'private'
+    elif watched:
+        priority = 'watched'
+    else:
+        priority = 'highlight'
+    enqueue(Notification(subject, body + suppressed_summary(),
+                         to=to, transport=transport, priority=priority))
+
+
+def format_subject(rule, default, **fields):
+    """Fills the subject template of a rule, {server}, {channel}, {nick},
+       {type} and {message} are replaced
+    """
+    try:
+        return rule.subject.format(**fields)
+    except (KeyError, IndexError, ValueError) as e:
+        error_msg('invalid subject in rule |%s|: %s' % (rule.name, e))
+        return default
+
+
+def parse_count(value):
+    """Parses a number that can't be negative"""
+    count = int(value)
+    if count < 0:
+        raise ValueError('must not be negative')
+    return count
 
-    debug_msg('sent |%s|%s|%s|%s|' % (config['from'], config['to'],
-                                      subject, body))
-    return weechat.WEECHAT_RC_OK
+
+def parse_positive(value):
+    """Parses a whole number of at least 1"""
+    number = int(value)
+    if number < 1:
+        raise ValueError('must be at least 1')
+    return number
+
+
+def parse_seconds(value):
+    """Parses a number of seconds above 0, fractions allowed"""
+    seconds = float(value)
+    if seconds <= 0:
+        raise ValueError('must be above 0')
+    return seconds
+
+
+# options used on the path of every ping, by the queue drain or by the
+# transports are parsed once by parse_option when they are set, PARSED
+# holds their last valid value
+OPTION_PARSERS = {
+    'max_concurrent': parse_positive,
+    'timeout': parse_positive,
+    'smtp_port': parse_positive,
+    'smtp_batch': parse_positive,
+    'smtp_idle_timeout': parse_positive,
+    'dedup_ttl': parse_count,
+    'dedup_size': parse_count,
+    'sender_rate': parse_rate,
+    'global_rate': parse_rate,
+    'queue_size': parse_count,
+    'digest_window': parse_positive,
+    'digest_max': parse_count,
+    'priority_weights': parse_weights,
+    'priority_caps': parse_priorities,
+    'spool_flush_interval': parse_seconds,
+}
+PARSED = {}
+
+
+def parse_option(option):
+    """Parses config[option] into PARSED. A value that doesn't parse is
+       reported and the last valid one, or the default, is kept.
+    """
+    parser = OPTION_PARSERS[option]
+    try:
+        PARSED[option] = parser(config[option])
+    except ValueError as e:
+        error_msg('invalid %s |%s|: %s' % (option, config[option], e))
+        if option not in PARSED:
+            PARSED[option] = parser(DEFAULTS[option])
 
 
 def update_config(data, option, value):
@@ -172,7 +1669,46 @@ def update_config(data, option, value):
        messages. (may be an unnecessary optimization)
     """
 
-    option = option.split('.')[-1]
-    config[option] = value
+    option = option[len('plugins.var.python.sendmail_notify.'):]
     debug_msg('updating config option |%s| to |%s|' % (option, value))
+
+    # rules are compiled as a whole whenever one of them changes
+    if option.startswith('rule.'):
+        if value:
+            RULE_OPTIONS[option[5:]] = value
+        else:
+            RULE_OPTIONS.pop(option[5:], None)
+        compile_rules()
+        return weechat.WEECHAT_RC_OK
+    config[option] = value
+
+    if option in OPTION_PARSERS:
+        parse_option(option)
+
+    if option == 'watchlist':
+        compile_watchlist()
+
+    # reconnect with the new settings on the next delivery
+    if option in ('transport', 'smtp_host', 'smtp_port'):
+        TRANSPORTS['smtp'].close()
+
+    # don't hold on to collected pings once digest is turned off
+    if option == 'digest' and value != 'on':
+        flush_digest()
     return weechat.WEECHAT_RC_OK
+
+
+for option in OPTION_PARSERS:
+    parse_option(option)
+load_rules()
+compile_watchlist()
+presence_cb('', 'screen_away_presence',
+            weechat.info_get('screen_away_presence', ''))
+
+# replay notifications a previous session couldn't deliver
+if config['spool'] == 'on':
+    REPLAY.extend(SPOOL.load())
+    if REPLAY:
+        weechat.prnt('', 'sendmail_notify: resending %d notifications from '
+                     'the spool' % len(REPLAY))
+        weechat.hook_timer(1, 0, 1, 'replay_cb', '')